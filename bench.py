@@ -0,0 +1,301 @@
+"""Нагрузочный стенд бота с локальными заглушками API Практикума и Telegram.
+
+Запуск:
+    python bench.py --tenants 1 100 10000 --engine async > bench_output.txt
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+HOMEWORK = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'homework.py')
+# Homework names are unique per API response, so a message can be
+# matched to the moment its status was served.
+NAME_PATTERN = re.compile(r'"(hw\d+)"')
+
+
+class Stats:
+    """Счётчики стенда, общие для обеих заглушек."""
+
+    def __init__(self):
+        """Создаём счётчики с нуля."""
+        self.lock = threading.Lock()
+        # Kept across resets: messages queued during warm-up still count.
+        self.served = {}
+        self.reset()
+
+    def reset(self):
+        """Начинаем измерение заново."""
+        with self.lock:
+            self.polls = 0
+            self.api_errors = 0
+            self.messages = 0
+            self.telegram_errors = 0
+            self.latencies = []
+
+    def serve(self, name):
+        """Запоминаем, когда API отдало домашку."""
+        with self.lock:
+            self.polls += 1
+            self.served[name] = time.perf_counter()
+
+    def receive(self, text):
+        """Учитываем сообщение, дошедшее до Telegram."""
+        match = NAME_PATTERN.search(text)
+        with self.lock:
+            self.messages += 1
+            served = match and self.served.pop(match.group(1), None)
+            if served:
+                self.latencies.append(time.perf_counter() - served)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Общая часть заглушек: задержка, ошибки и ответ в JSON."""
+
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes: without this every
+    # keep-alive response waits for the client's delayed ACK.
+    disable_nagle_algorithm = True
+
+    def reply(self, status, payload):
+        """Отправляем JSON-ответ."""
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def should_fail(self):
+        """Выдерживаем задержку и решаем, ответить ли ошибкой."""
+        time.sleep(self.server.latency)
+        return random.random() < self.server.error_rate
+
+    def log_message(self, format, *args):
+        """Журнал запросов заглушкам не нужен."""
+
+
+class PracticumHandler(StubHandler):
+    """Заглушка API Практикума: каждый ответ меняет статус домашки."""
+
+    def do_GET(self):
+        """Отдаём новую версию домашки пользователя."""
+        if self.should_fail():
+            self.server.stats.api_errors += 1
+            self.reply(HTTPStatus.INTERNAL_SERVER_ERROR, {'code': 'error'})
+            return
+        name = f'hw{next(self.server.sequence)}'
+        self.server.stats.serve(name)
+        homework = {
+            'id': self.headers.get('Authorization'),
+            'homework_name': name,
+            'status': 'approved',
+            'date_updated': name,
+            'reviewer_comment': 'x' * self.server.payload_size,
+        }
+        self.reply(HTTPStatus.OK, {
+            'homeworks': [homework], 'current_date': int(time.time())
+        })
+
+
+class TelegramHandler(StubHandler):
+    """Заглушка Bot API: принимает sendMessage."""
+
+    def do_POST(self):
+        """Принимаем сообщение из query или тела формы."""
+        length = int(self.headers.get('Content-Length') or 0)
+        params = parse_qs(urlsplit(self.path).query)
+        params.update(parse_qs(self.rfile.read(length).decode()))
+        if self.should_fail():
+            self.server.stats.telegram_errors += 1
+            self.reply(HTTPStatus.INTERNAL_SERVER_ERROR, {
+                'ok': False, 'error_code': 500, 'description': 'stub error'
+            })
+            return
+        text = params.get('text', [''])[0]
+        self.server.stats.receive(text)
+        self.reply(HTTPStatus.OK, {'ok': True, 'result': {
+            'message_id': 1,
+            'date': int(time.time()),
+            'chat': {'id': int(params.get('chat_id', [0])[0]),
+                     'type': 'private'},
+            'text': text,
+        }})
+
+    # The asyncio client of pyTelegramBotAPI sends the form with GET.
+    do_GET = do_POST
+
+
+class StubServer(ThreadingHTTPServer):
+    """HTTP-сервер заглушки."""
+
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        """Бот закрывает соединения при остановке: это не ошибка."""
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def start_stub(handler, stats, latency, error_rate, payload_size=0):
+    """Запускаем заглушку в фоновом потоке и возвращаем её адрес."""
+    server = StubServer(('127.0.0.1', 0), handler)
+    server.stats = stats
+    server.latency = latency
+    server.error_rate = error_rate
+    server.payload_size = payload_size
+    server.sequence = itertools.count()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.server_port}'
+
+
+def write_tenants(directory, count):
+    """Пишем реестр из count пользователей."""
+    path = os.path.join(directory, 'tenants.json')
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump([
+            {'name': f'tenant{i}', 'practicum_token': f'token{i}',
+             'chat_id': i + 1}
+            for i in range(count)
+        ], file)
+    return path
+
+
+def read_memory(pid):
+    """Текущий и пиковый RSS процесса в МиБ (только Linux)."""
+    try:
+        with open(f'/proc/{pid}/status', encoding='ascii') as file:
+            fields = dict(line.split(':', 1) for line in file)
+    except OSError:
+        return None, None
+    return tuple(
+        int(fields[key].split()[0]) / 1024 for key in ('VmRSS', 'VmHWM')
+    )
+
+
+def percentile(values, fraction):
+    """Перцентиль по отсортированной выборке."""
+    if not values:
+        return float('nan')
+    return values[round(fraction * (len(values) - 1))]
+
+
+def run_scenario(args, stats, api_url, telegram_url, tenants):
+    """Гоняем настоящий цикл опроса на tenants пользователях."""
+    with tempfile.TemporaryDirectory() as directory:
+        env = dict(
+            os.environ,
+            PRACTICUM_ENDPOINT=api_url + '/',
+            TELEGRAM_API_URL=telegram_url,
+            TELEGRAM_TOKEN='bench',
+            TENANTS_FILE=write_tenants(directory, tenants),
+            RETRY_PERIOD=str(args.period),
+            SEND_GLOBAL_RATE=str(args.send_rate),
+            SEND_CHAT_RATE=str(args.send_rate),
+            LOG_LEVEL=args.log_level,
+        )
+        process = subprocess.Popen(
+            [sys.executable, HOMEWORK, '--engine', args.engine],
+            env=env, stdout=subprocess.DEVNULL
+        )
+        try:
+            time.sleep(args.warmup)
+            stats.reset()
+            started = time.perf_counter()
+            time.sleep(args.duration)
+            elapsed = time.perf_counter() - started
+            if process.poll() is not None:
+                raise RuntimeError(
+                    f'Бот завершился с кодом {process.returncode}.'
+                )
+            rss, peak = read_memory(process.pid)
+        finally:
+            process.terminate()
+            process.wait()
+    with stats.lock:
+        latencies = sorted(stats.latencies)
+        return {
+            'tenants': tenants,
+            'engine': args.engine,
+            'polls_per_second': stats.polls / elapsed,
+            'messages_per_second': stats.messages / elapsed,
+            'p50_ms': percentile(latencies, 0.5) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000,
+            'rss_mib': rss,
+            'peak_rss_mib': peak,
+            'api_errors': stats.api_errors,
+            'telegram_errors': stats.telegram_errors,
+        }
+
+
+def format_row(result):
+    """Строка таблицы результатов."""
+    return (
+        '{tenants:>8} {engine:>6} {polls_per_second:>9.1f} '
+        '{messages_per_second:>9.1f} {p50_ms:>8.1f} {p99_ms:>8.1f} '
+        '{rss_mib:>8.1f} {peak_rss_mib:>8.1f} {api_errors:>7} '
+        '{telegram_errors:>7}'.format(**result)
+    )
+
+
+def parse_args(argv=None):
+    """Разбираем аргументы командной строки."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tenants', type=int, nargs='+',
+                        default=[1, 100, 10_000])
+    parser.add_argument('--engine', choices=('sync', 'async'),
+                        default='sync')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='Длительность замера, секунд.')
+    parser.add_argument('--warmup', type=float, default=3,
+                        help='Прогрев перед замером, секунд.')
+    parser.add_argument('--period', type=int, default=0,
+                        help='RETRY_PERIOD бота, 0 -- опрос без пауз.')
+    parser.add_argument('--api-latency', type=float, default=0.01)
+    parser.add_argument('--api-error-rate', type=float, default=0)
+    parser.add_argument('--payload-size', type=int, default=0,
+                        help='Размер reviewer_comment в байтах.')
+    parser.add_argument('--telegram-latency', type=float, default=0.01)
+    parser.add_argument('--telegram-error-rate', type=float, default=0)
+    parser.add_argument('--send-rate', type=float, default=100_000,
+                        help='Лимиты очереди отправки, сообщений/с.')
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('--json', action='store_true',
+                        help='Печатать результаты строками JSON.')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Прогоняем сценарии и печатаем результаты."""
+    args = parse_args(argv)
+    stats = Stats()
+    api_url = start_stub(
+        PracticumHandler, stats, args.api_latency, args.api_error_rate,
+        args.payload_size
+    )
+    telegram_url = start_stub(
+        TelegramHandler, stats, args.telegram_latency,
+        args.telegram_error_rate
+    )
+    if not args.json:
+        print(' tenants engine   polls/s    msgs/s   p50 ms   p99 ms '
+              '  rss MiB peak MiB api err  tg err')
+    for tenants in args.tenants:
+        result = run_scenario(args, stats, api_url, telegram_url, tenants)
+        print(json.dumps(result) if args.json else format_row(result),
+              flush=True)
+
+
+if __name__ == '__main__':
+    main()
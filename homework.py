@@ -1,42 +1,313 @@
+import atexit
+import bisect
+import codecs
+import glob
+import hashlib
+import heapq
+import hmac
+import importlib
+import itertools
+import json
 import logging
+import math
 import os
+import queue
+import random
+import re
+import signal
+import socket
 import sys
+import threading
 import time
+import zlib
+from collections import OrderedDict, namedtuple
+from contextlib import closing, contextmanager
+from datetime import datetime
+from functools import cached_property
 from http import HTTPStatus
+from http.client import RemoteDisconnected
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from logging import StreamHandler
+from logging.handlers import QueueHandler, QueueListener
+from operator import itemgetter
+from urllib.parse import unquote, urlsplit
 
-import requests
 from dotenv import load_dotenv
-from telebot import TeleBot
-from telebot.apihelper import ApiTelegramException
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Time spent on startup steps, shown by STARTUP_REPORT.
+startup_times = []
+module_started = time.perf_counter()
+
+
+class Lazy:
+    """Объект, который создаётся при первом обращении к нему."""
+
+    def __init__(self, name, factory):
+        """Запоминаем, как создать объект при первом обращении."""
+        self.name = name
+        self.factory = factory
+        self.target = None
+        self.lock = threading.Lock()
+
+    def resolve(self):
+        """Создаём объект, если он ещё не создан."""
+        if self.target is None:
+            with self.lock:
+                if self.target is None:
+                    started = time.perf_counter()
+                    target = self.factory()
+                    startup_times.append(
+                        (self.name, time.perf_counter() - started)
+                    )
+                    self.target = target
+        return self.target
+
+    def __getattr__(self, attribute):
+        """Атрибут созданного объекта."""
+        return getattr(self.resolve(), attribute)
+
+    def __call__(self, *args, **kwargs):
+        """Вызов созданного объекта."""
+        return self.resolve()(*args, **kwargs)
+
+
+def lazy_import(name, attribute=None):
+    """Модуль или его атрибут, импортируемые при первом обращении."""
+    def load():
+        module = importlib.import_module(name)
+        return module if attribute is None else getattr(module, attribute)
+    return Lazy(name if attribute is None else f'{name}.{attribute}', load)
+
+
+# Heavy dependencies: a one-shot run or the sync engine never pays for
+# aiohttp and asyncio, and Telegram is imported only to send a message.
+aiohttp = lazy_import('aiohttp')
+apihelper = lazy_import('telebot.apihelper')
+argparse = lazy_import('argparse')
+asyncio = lazy_import('asyncio')
+asyncio_helper = lazy_import('telebot.asyncio_helper')
+requests = lazy_import('requests')
+sqlite3 = lazy_import('sqlite3')
+subprocess = lazy_import('subprocess')
+web = lazy_import('aiohttp.web')
+AsyncTeleBot = lazy_import('telebot.async_telebot', 'AsyncTeleBot')
+TeleBot = lazy_import('telebot', 'TeleBot')
+ThreadPoolExecutor = lazy_import('concurrent.futures', 'ThreadPoolExecutor')
+parsedate_to_datetime = lazy_import('email.utils', 'parsedate_to_datetime')
+
+# Loading variables from environment.
+load_dotenv()
+
+# Faster JSON decoder when orjson is installed.
+json_loads = json.loads if orjson is None else orjson.loads
 
 # Logging settings.
 format = (
     '%(levelname)s, func: %(funcName)s, line: %(lineno)d, '
     '%(name)s, %(asctime)s, %(message)s,'
 )
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'DEBUG').upper()
+# "text" or "json" (one JSON object per line).
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')
+# Write log records from a background thread instead of the poll loop.
+LOG_QUEUE = os.getenv('LOG_QUEUE', '').lower() in ('1', 'true', 'yes')
+
+
+class JsonFormatter(logging.Formatter):
+    """Форматирование записи лога в одну строку JSON."""
+
+    def format(self, record):
+        """Собираем только дешёвые поля записи, без asctime."""
+        entry = {
+            'time': record.created,
+            'level': record.levelname,
+            'func': record.funcName,
+            'line': record.lineno,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class LazyQueueHandler(QueueHandler):
+    """Передаёт запись в очередь без форматирования в потоке вызова."""
+
+    def prepare(self, record):
+        """Сообщение будет отформатировано в потоке QueueListener."""
+        return record
+
+
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
+logger.setLevel(LOG_LEVEL)
 handler = StreamHandler(stream=sys.stdout)
-handler.setFormatter(logging.Formatter(format))
-logger.addHandler(handler)
-
-# Loading variables from environment.
-load_dotenv()
+if LOG_FORMAT == 'json':
+    handler.setFormatter(JsonFormatter())
+else:
+    handler.setFormatter(logging.Formatter(format))
+if LOG_QUEUE:
+    log_queue = queue.SimpleQueue()
+    logger.addHandler(LazyQueueHandler(log_queue))
+    log_listener = QueueListener(log_queue, handler)
+    log_listener.start()
+    atexit.register(log_listener.stop)
+else:
+    logger.addHandler(handler)
 
 # Access variables.
 PRACTICUM_TOKEN = os.getenv('PRACTICUM_TOKEN')
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
 TELEGRAM_CHAT_ID = os.getenv('TELEGRAM_CHAT_ID')
-RETRY_PERIOD = os.getenv('RETRY_PERIOD')
+RETRY_PERIOD = int(os.getenv('RETRY_PERIOD', 600))
+
+# Polling engine: "sync" (blocking main loop) or "async" (asyncio).
+ENGINES = ('sync', 'async')
+ENGINE = os.getenv('ENGINE', 'sync')
+
+# Print the time of startup steps and deferred imports to stderr on
+# exit, in the format of `python -X importtime`.
+STARTUP_REPORT = os.getenv('STARTUP_REPORT', '').lower() in (
+    '1', 'true', 'yes'
+)
+
+# Threads polling tenants in a --once run, and its exit codes when
+# some or all of the polled tenants failed (1 is a configuration error).
+ONCE_WORKERS = int(os.getenv('ONCE_WORKERS', 16))
+EXIT_PARTIAL = 2
+EXIT_FAILED = 3
 
-# Number of "response" in homeworks list.
-HOMEWORK_NUMBER = 0
+# Poll scheduling: "period" sleeps RETRY_PERIOD after each round,
+# "deadline" keeps per-tenant deadlines on the monotonic clock.
+SCHEDULERS = ('period', 'deadline')
+SCHEDULER = os.getenv('SCHEDULER', 'period')
+# Spread tenants over the period by a phase derived from their token,
+# and add up to POLL_JITTER random seconds to every deadline.
+POLL_STAGGER = os.getenv(
+    'POLL_STAGGER', '1' if SCHEDULER == 'deadline' else ''
+).lower() in ('1', 'true', 'yes')
+POLL_JITTER = float(os.getenv('POLL_JITTER', 0))
+# Resolution of the planned load curve published in the metrics.
+PLAN_BUCKETS = int(os.getenv('PLAN_BUCKETS', 60))
+
+# Tenant registry (JSON or SQLite) for watching many tokens at once.
+TENANTS_FILE = os.getenv('TENANTS_FILE')
+SQLITE_SUFFIXES = ('.db', '.sqlite', '.sqlite3')
+
+# Supervisor mode: tenants are split between WORKERS processes by
+# consistent hashing; WORKER_ID is set by the supervisor for a worker.
+WORKERS = int(os.getenv('WORKERS', 0))
+WORKER_ID = os.getenv('WORKER_ID')
+RING_REPLICAS = 64
+WORKER_CHECK_INTERVAL = 1
+WORKER_RESTART_DELAY = int(os.getenv('WORKER_RESTART_DELAY', 5))
+
+# Leases across nodes: a tenant is polled only by the node holding its
+# lease in the shared LEASE_FILE. Expiry uses wall clocks of the nodes,
+# so LEASE_TTL must exceed their skew.
+LEASE_BACKEND = os.getenv('LEASE_BACKEND', 'sqlite')
+LEASE_FILE = os.getenv('LEASE_FILE')
+LEASE_TTL = float(os.getenv('LEASE_TTL', 30))
+# Tenants of other workers or nodes are checked this often for handover.
+HANDOVER_CHECK_PERIOD = LEASE_TTL / 3
+NODE_ID = os.getenv('NODE_ID', f'{socket.gethostname()}:{os.getpid()}')
 
 # Connection settings.
-ENDPOINT = 'https://practicum.yandex.ru/api/user_api/homework_statuses/'
+ENDPOINT = os.getenv(
+    'PRACTICUM_ENDPOINT',
+    'https://practicum.yandex.ru/api/user_api/homework_statuses/'
+)
+# Alternative Bot API server, e.g. a local one or a test stand.
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
 HEADERS = {'Authorization': f'OAuth {PRACTICUM_TOKEN}'}
 
+# HTTP connection pool settings. Pool is disabled when API_POOL_SIZE is 0.
+API_POOL_SIZE = int(os.getenv('API_POOL_SIZE', 10 if TENANTS_FILE else 0))
+API_CONNECT_TIMEOUT = float(os.getenv('API_CONNECT_TIMEOUT', 5))
+API_READ_TIMEOUT = float(os.getenv('API_READ_TIMEOUT', 30))
+# A keep-alive socket closed by the server fails the next request with
+# one of these; other connection errors are outages left to the backoff.
+STALE_CONNECTION_ERRORS = (RemoteDisconnected, ConnectionResetError)
+
+# Backoff of failed API requests and circuit breaker settings.
+BACKOFF_BASE = float(os.getenv('BACKOFF_BASE', 30))
+BACKOFF_MAX = float(os.getenv('BACKOFF_MAX', 3600))
+BREAKER_THRESHOLD = int(os.getenv('BREAKER_THRESHOLD', 5))
+BREAKER_RESET_TIMEOUT = float(os.getenv('BREAKER_RESET_TIMEOUT', 300))
+
+# Adaptive polling: poll often while homework is under review and back off
+# exponentially while there is nothing to wait for.
+ADAPTIVE_POLLING = os.getenv('ADAPTIVE_POLLING', '').lower() in (
+    '1', 'true', 'yes'
+)
+ACTIVE_PERIOD = int(os.getenv('ACTIVE_PERIOD', 60))
+IDLE_MAX_PERIOD = int(os.getenv('IDLE_MAX_PERIOD', 3600))
+IDLE_BACKOFF = float(os.getenv('IDLE_BACKOFF', 2))
+
+# Max number of homework states kept in memory (least recent are evicted).
+STATE_STORE_SIZE = int(os.getenv('STATE_STORE_SIZE', 1_000_000))
+
+# Journal of polling cursors and homework states kept between restarts.
+STATE_FILE = os.getenv('STATE_FILE')
+STATE_FSYNC_INTERVAL = float(os.getenv('STATE_FSYNC_INTERVAL', 5))
+
+# Outbound Telegram queue: background senders within Telegram rate limits.
+SEND_QUEUE = os.getenv('SEND_QUEUE', '1' if TENANTS_FILE else '').lower() in (
+    '1', 'true', 'yes'
+)
+SEND_WORKERS = int(os.getenv('SEND_WORKERS', 4))
+SEND_GLOBAL_RATE = float(os.getenv('SEND_GLOBAL_RATE', 30))
+SEND_CHAT_RATE = float(os.getenv('SEND_CHAT_RATE', 1))
+SEND_MAX_ATTEMPTS = int(os.getenv('SEND_MAX_ATTEMPTS', 5))
+
+# Durable outbox of Telegram messages, retried until delivered.
+OUTBOX_FILE = os.getenv('OUTBOX_FILE')
+OUTBOX_FLUSH_INTERVAL = float(os.getenv('OUTBOX_FLUSH_INTERVAL', 1))
+OUTBOX_RETRY_INTERVAL = float(os.getenv('OUTBOX_RETRY_INTERVAL', 60))
+# Telegram errors that will not go away on retry (bad chat, blocked bot).
+PERMANENT_SEND_ERRORS = (HTTPStatus.BAD_REQUEST, HTTPStatus.FORBIDDEN)
+
+# Messages to a chat within DIGEST_WINDOW seconds after the last one it
+# got are joined into a single digest; 0 sends every message at once.
+DIGEST_WINDOW = float(os.getenv('DIGEST_WINDOW', 0))
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# Webhook receiver of homework status events. While it is enabled, polling
+# only reconciles missed events once per WEBHOOK_RECONCILE_PERIOD.
+# Like metrics, events are accepted only locally unless WEBHOOK_HOST is
+# set, and an external address requires WEBHOOK_SECRET.
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '127.0.0.1')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 0))
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_MAX_BODY = int(os.getenv('WEBHOOK_MAX_BODY', 1024 * 1024))
+LOOPBACK_HOSTS = ('127.0.0.1', '::1', 'localhost')
+WEBHOOK_RECONCILE_PERIOD = int(os.getenv('WEBHOOK_RECONCILE_PERIOD', 3600))
+WEBHOOK_PATH = '/homeworks/'
+
+# Local HTTP endpoint with Prometheus metrics, 0 disables it.
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+DRIFT_BUCKETS = (0.001, 0.01, 0.1, 1, 10, 60)
+
+# "current_date" changes on every response, so it is left out of the
+# hash that detects unchanged bodies.
+CURRENT_DATE_PATTERN = re.compile(rb'"current_date"\s*:\s*\d+')
+
+# Backfill reads the whole history (from_date=0) as a stream of chunks
+# and syncs the state journal after every BACKFILL_CHECKPOINT homeworks.
+BACKFILL_CHUNK_SIZE = 64 * 1024
+BACKFILL_CHECKPOINT = int(os.getenv('BACKFILL_CHECKPOINT', 1000))
+HOMEWORKS_START_PATTERN = re.compile(r'"homeworks"\s*:\s*\[')
+CURRENT_DATE_FIELD_PATTERN = re.compile(r'"current_date"\s*:\s*(\d+)')
+
+# Max simultaneous connections of the async engine.
+ASYNC_CONNECTION_LIMIT = int(os.getenv('ASYNC_CONNECTION_LIMIT', 100))
+
 # Connection retry period in seconds.
 
 # Expected values of "response" status.
@@ -45,6 +316,868 @@ HOMEWORK_VERDICTS = {
     'reviewing': 'Работа взята на проверку ревьюером.',
     'rejected': 'Работа проверена: у ревьюера есть замечания.'
 }
+# Statuses are stored as small ints, which Python shares between
+# records, and packed with the update time into a single int of state.
+STATUSES = tuple(HOMEWORK_VERDICTS)
+STATUS_CODES = {status: code for code, status in enumerate(STATUSES)}
+REVIEWING = STATUS_CODES['reviewing']
+STATUS_BITS = 2
+STATUS_MASK = (1 << STATUS_BITS) - 1
+
+
+def init_telegram_api(helper):
+    """Направляем запросы бота на TELEGRAM_API_URL, если он задан."""
+    if TELEGRAM_API_URL:
+        helper.resolve().API_URL = (
+            TELEGRAM_API_URL.rstrip('/') + '/bot{0}/{1}'
+        )
+
+
+class Counter:
+    """Счётчик Prometheus с одной меткой или без меток."""
+
+    def __init__(self, name, help, label=None):
+        """Создаём счётчик с нулевыми значениями."""
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, label_value=None, amount=1):
+        """Увеличиваем счётчик для значения метки."""
+        with self.lock:
+            self.values[label_value] = (
+                self.values.get(label_value, 0) + amount
+            )
+
+    def render(self):
+        """Строки метрики в текстовом формате Prometheus."""
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} counter'
+        with self.lock:
+            values = list(self.values.items())
+        for label_value, value in values:
+            labels = (
+                f'{{{self.label}="{label_value}"}}' if self.label else ''
+            )
+            yield f'{self.name}{labels} {value}'
+
+
+class Histogram:
+    """Гистограмма Prometheus."""
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        """Создаём гистограмму с пустыми корзинами."""
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        # The last slot counts observations above the largest bucket.
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        """Учитываем одно наблюдение."""
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    @contextmanager
+    def time(self):
+        """Измеряем время выполнения блока."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+    def render(self):
+        """Строки метрики в текстовом формате Prometheus."""
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} histogram'
+        # A consistent snapshot: buckets must add up to the count.
+        with self.lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        cumulative = 0
+        for bound, bucket in zip(self.buckets, counts):
+            cumulative += bucket
+            yield f'{self.name}_bucket{{le="{bound}"}} {cumulative}'
+        yield f'{self.name}_bucket{{le="+Inf"}} {count}'
+        yield f'{self.name}_sum {total}'
+        yield f'{self.name}_count {count}'
+
+
+class Gauge:
+    """Показатель Prometheus, вычисляемый при каждом сборе метрик."""
+
+    def __init__(self, name, help, collect):
+        """Запоминаем функцию, которая вычисляет значения."""
+        self.name = name
+        self.help = help
+        # Returns pairs of (labels string, value), labels may be empty.
+        self.collect = collect
+
+    def render(self):
+        """Строки метрики в текстовом формате Prometheus."""
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} gauge'
+        for labels, value in self.collect():
+            yield f'{self.name}{labels} {value}'
+
+
+class Metrics:
+    """Метрики опроса API и отправки сообщений."""
+
+    def __init__(self):
+        """Создаём метрики опроса и отправки."""
+        self.api_latency = Histogram(
+            'homework_api_request_seconds', 'Время запроса к API домашек.'
+        )
+        self.telegram_latency = Histogram(
+            'homework_telegram_send_seconds',
+            'Время отправки сообщения в Telegram.'
+        )
+        self.sleep_drift = Histogram(
+            'homework_sleep_drift_seconds',
+            'Насколько ожидание между опросами дольше запланированного.',
+            DRIFT_BUCKETS
+        )
+        self.poll_errors = Counter(
+            'homework_poll_errors_total',
+            'Ошибки цикла опроса по типу исключения.', 'type'
+        )
+        self.poll_overruns = Counter(
+            'homework_poll_overruns_total',
+            'Опросы, пропустившие свой срок больше чем на период.'
+        )
+        self.gauges = {}
+
+    def add_gauge(self, name, help, collect):
+        """Регистрируем вычисляемый показатель."""
+        self.gauges[name] = Gauge(name, help, collect)
+
+    def render(self):
+        """Все метрики в текстовом формате Prometheus."""
+        collected = [
+            self.api_latency, self.telegram_latency, self.sleep_drift,
+            self.poll_errors, self.poll_overruns, *self.gauges.values()
+        ]
+        lines = itertools.chain.from_iterable(
+            metric.render() for metric in collected
+        )
+        return '\n'.join(lines) + '\n'
+
+
+# Updated from the polling, sending and webhook threads: counters and
+# histograms guard their read-modify-write updates with own locks.
+metrics = Metrics()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Отдаём метрики по запросу GET /metrics."""
+
+    def do_GET(self):
+        """Отвечаем текстом метрик."""
+        if self.path != '/metrics':
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+        payload = self.render().encode()
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def render(self):
+        """Метрики этого процесса."""
+        return metrics.render()
+
+    def log_message(self, format, *args):
+        """Пишем журнал запросов в лог бота."""
+        logger.debug(format, *args)
+
+
+def serve_metrics(handler, **attributes):
+    """Запускаем HTTP-сервер метрик в фоновом потоке."""
+    server = ThreadingHTTPServer((METRICS_HOST, METRICS_PORT), handler)
+    server.daemon_threads = True
+    for name, value in attributes.items():
+        setattr(server, name, value)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info('Метрики на http://%s:%s/metrics', METRICS_HOST, METRICS_PORT)
+    return server
+
+
+def start_metrics_server(tenants, breaker):
+    """Запускаем HTTP-эндпоинт /metrics, если он включен."""
+    if not METRICS_PORT:
+        return None
+    metrics.add_gauge(
+        'homework_last_success_age_seconds',
+        'Сколько секунд назад API успешно ответило для пользователя.',
+        lambda: [
+            (f'{{tenant="{tenant.name}"}}',
+             time.monotonic() - tenant.last_success)
+            for tenant in tenants if tenant.last_success is not None
+        ]
+    )
+    metrics.add_gauge(
+        'homework_api_breaker_open',
+        'Опрос API приостановлен размыкателем цепи.',
+        lambda: [('', int(breaker.state != breaker.CLOSED))]
+    )
+    return serve_metrics(MetricsHandler)
+
+
+def is_stale_connection(error):
+    """Проверяем, закрыл ли сервер соединение из пула."""
+    # requests wraps urllib3's ProtocolError('Connection aborted.', cause).
+    reason = error.args[0] if error.args else None
+    causes = getattr(reason, 'args', ())
+    return bool(causes) and isinstance(causes[-1], STALE_CONNECTION_ERRORS)
+
+
+class ApiClient:
+    """Пул HTTP-соединений с keep-alive, общий для запросов к API."""
+
+    def __init__(
+        self, pool_size=10, timeout=(API_CONNECT_TIMEOUT, API_READ_TIMEOUT)
+    ):
+        """Создаём сессию с пулом соединений нужного размера."""
+        self.pool_size = pool_size
+        self.timeout = timeout
+        # Retries of failed requests are left to the backoff and the
+        # circuit breaker, so the adapter keeps its default of none.
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size
+        )
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def get(self, url, **kwargs):
+        """GET-запрос через пул с повтором на устаревшем сокете."""
+        kwargs.setdefault('timeout', self.timeout)
+        try:
+            return self.session.get(url, **kwargs)
+        except requests.ConnectionError as error:
+            if not is_stale_connection(error):
+                raise
+            # The pool drops the dead socket and opens a new one.
+            logger.warning('Соединение из пула разорвано, повторяем запрос')
+            return self.session.get(url, **kwargs)
+
+    def close(self):
+        """Закрываем все соединения пула."""
+        self.session.close()
+
+
+# Shared HTTP client, "None" means plain "requests" without pooling.
+api_client = None
+
+
+def set_api_client(client):
+    """Устанавливаем общий HTTP-клиент (в том числе для тестов)."""
+    global api_client
+    api_client = client
+
+
+def get_api_client():
+    """Возвращаем общий HTTP-клиент для запросов к API."""
+    if api_client is None:
+        return requests
+    return api_client
+
+
+def init_api_client():
+    """Включаем пул соединений, если он задан в окружении."""
+    if API_POOL_SIZE and api_client is None:
+        set_api_client(ApiClient(pool_size=API_POOL_SIZE))
+        logger.info('Включен пул HTTP-соединений: %s', API_POOL_SIZE)
+
+
+class ApiResponseError(ValueError):
+    """Ответ API с кодом, отличным от 200."""
+
+    def __init__(self, status_code, retry_after=None):
+        """Запоминаем код ответа и Retry-After."""
+        super().__init__(
+            f'Ошибка ответа сервера - Status_code: {status_code}'
+        )
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+    @property
+    def is_transient(self):
+        """Сбой на стороне сервера, запрос стоит повторить позже."""
+        return (
+            self.status_code == HTTPStatus.TOO_MANY_REQUESTS
+            or self.status_code >= HTTPStatus.INTERNAL_SERVER_ERROR
+        )
+
+
+def parse_retry_after(value):
+    """Получаем задержку в секундах из заголовка Retry-After."""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        retry_date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(retry_date.timestamp() - time.time(), 0)
+
+
+def get_backoff_delay(failures, retry_after=None):
+    """Задержка перед повтором: экспонента с полным джиттером."""
+    ceiling = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** min(failures, 32))
+    delay = random.uniform(0, ceiling)
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+
+class CircuitBreaker:
+    """Размыкатель цепи: приостанавливает опрос API при серии сбоев."""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(
+        self, threshold=BREAKER_THRESHOLD,
+        reset_timeout=BREAKER_RESET_TIMEOUT
+    ):
+        """Создаём замкнутый размыкатель."""
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.retry_at = 0
+        self.last_error = None
+        self.probing = False
+        # Shared by the polling threads of --once and the webhook, and
+        # only one of them may take the half-open probe.
+        self.lock = threading.Lock()
+
+    def allow_request(self):
+        """Разрешаем запрос; в полуоткрытом состоянии - одну пробу."""
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if (
+                self.state == self.OPEN
+                and time.monotonic() >= self.retry_at
+            ):
+                self._set_state(self.HALF_OPEN)
+            if self.state == self.HALF_OPEN and not self.probing:
+                self.probing = True
+                return True
+            return False
+
+    def record_success(self):
+        """API ответило: замыкаем цепь."""
+        with self.lock:
+            self.failures = 0
+            self.probing = False
+            if self.state != self.CLOSED:
+                self._set_state(self.CLOSED)
+
+    def record_failure(self, error, retry_after=None):
+        """Учитываем сбой и размыкаем цепь после серии сбоев."""
+        with self.lock:
+            self.failures += 1
+            self.probing = False
+            self.last_error = str(error)
+            if (
+                self.state == self.HALF_OPEN
+                or self.failures >= self.threshold
+            ):
+                self.retry_at = time.monotonic() + max(
+                    self.reset_timeout, retry_after or 0
+                )
+                self._set_state(self.OPEN)
+
+    def get_status(self):
+        """Состояние размыкателя для мониторинга."""
+        with self.lock:
+            return {
+                'state': self.state,
+                'failures': self.failures,
+                'retry_in': max(self.retry_at - time.monotonic(), 0),
+                'last_error': self.last_error,
+            }
+
+    def _set_state(self, state):
+        """Переключаем состояние и сообщаем об этом в лог."""
+        logger.warning(
+            'Circuit breaker: %s -> %s. Последняя ошибка: %s',
+            self.state, state, self.last_error
+        )
+        self.state = state
+
+
+class ResponseCache:
+    """Валидаторы последнего обработанного ответа API."""
+
+    def __init__(self):
+        """Создаём пустой кеш ответа."""
+        self.etag = None
+        self.last_modified = None
+        self.digest = None
+        # Validators of the response being processed right now; they are
+        # kept only once processing succeeds.
+        self.pending = None
+
+    def get_headers(self, headers):
+        """Добавляем к запросу условия If-None-Match и If-Modified-Since."""
+        conditions = {}
+        if self.etag:
+            conditions['If-None-Match'] = self.etag
+        if self.last_modified:
+            conditions['If-Modified-Since'] = self.last_modified
+        return {**headers, **conditions} if conditions else headers
+
+    def is_unchanged(self, headers, body):
+        """Сверяем тело ответа с прошлым и запоминаем валидаторы."""
+        digest = None
+        if body is not None:
+            digest = hashlib.blake2b(
+                CURRENT_DATE_PATTERN.sub(b'', body), digest_size=16
+            ).digest()
+        self.pending = (
+            headers.get('ETag'), headers.get('Last-Modified'), digest
+        )
+        return digest is not None and digest == self.digest
+
+    def commit(self):
+        """Ответ обработан: следующие запросы можно делать условными."""
+        if self.pending is not None:
+            self.etag, self.last_modified, self.digest = self.pending
+            self.pending = None
+
+
+class Tenant:
+    """Пользователь бота: токен Практикума, чат и состояние опроса."""
+
+    def __init__(self, name, practicum_token=None, chat_id=None):
+        """Создаём пользователя с пустым состоянием опроса."""
+        self.name = name
+        self.practicum_token = practicum_token
+        self.chat_id = chat_id
+        # Tenant without own token is the one configured by environment.
+        if practicum_token is None:
+            self.headers = HEADERS
+        else:
+            self.headers = {'Authorization': f'OAuth {practicum_token}'}
+        self.timestamp = int(time.time())
+        self.last_error = ''
+        # Ids of homeworks under review and the polling schedule.
+        self.reviewing = set()
+        self.interval = self.base_interval
+        self.next_poll = 0
+        # Called with the tenant when it is handed over to this process,
+        # so the scheduler polls it at once.
+        self.on_reset = None
+        # Guards homework processing shared by polling and the webhook.
+        self.lock = threading.Lock()
+        # Consecutive failed API requests and the server's Retry-After.
+        self.failures = 0
+        self.retry_after = None
+        self.last_success = None
+        self.cache = ResponseCache()
+        # Cleared while the tenant belongs to another worker process
+        # or its lease is held by another node.
+        self.owned = True
+        self.leased = True
+
+    @property
+    def base_interval(self):
+        """Период опроса без адаптации и повторов."""
+        return WEBHOOK_RECONCILE_PERIOD if WEBHOOK_PORT else RETRY_PERIOD
+
+    @property
+    def active(self):
+        """Проверяем, опрашивает ли пользователя этот процесс."""
+        return self.owned and self.leased
+
+    @cached_property
+    def async_lock(self):
+        """Блокировка для движка asyncio, создаётся только в нём."""
+        return asyncio.Lock()
+
+    def track_review(self, homework):
+        """Запоминаем, находится ли домашка на проверке."""
+        if homework.status == REVIEWING:
+            self.reviewing.add(homework.key)
+        else:
+            self.reviewing.discard(homework.key)
+
+    def is_due(self):
+        """Проверяем, пора ли опрашивать API для пользователя."""
+        return self.next_poll <= time.monotonic()
+
+    def schedule_next_poll(self):
+        """Планируем следующий опрос по статусам домашек и сбоям."""
+        if not self.active:
+            # The tenant is not polled here, so its schedule must not back
+            # off; a short check notices when it is handed over.
+            self.interval = self.base_interval
+            self.next_poll = time.monotonic() + HANDOVER_CHECK_PERIOD
+            return HANDOVER_CHECK_PERIOD
+        if self.failures:
+            delay = get_backoff_delay(self.failures, self.retry_after)
+            self.next_poll = time.monotonic() + delay
+            return delay
+        if ADAPTIVE_POLLING:
+            if self.reviewing:
+                self.interval = ACTIVE_PERIOD
+            else:
+                self.interval = min(
+                    self.interval * IDLE_BACKOFF, IDLE_MAX_PERIOD
+                )
+        self.next_poll = time.monotonic() + self.interval
+        return self.interval
+
+    def reset_schedule(self):
+        """Опрашиваем перешедшего к процессу пользователя без задержки."""
+        self.interval = self.base_interval
+        self.next_poll = time.monotonic()
+        if self.on_reset is not None:
+            self.on_reset(self)
+
+    def record_api_success(self, breaker):
+        """API ответило 200 или 304: сбрасываем отсрочку повтора."""
+        self.reset_failures(breaker)
+        self.last_success = time.monotonic()
+
+    def reset_failures(self, breaker):
+        """Сервер доступен: сбрасываем отсрочку повтора."""
+        self.failures = 0
+        self.retry_after = None
+        breaker.record_success()
+
+    def record_api_failure(self, breaker, error):
+        """Учитываем сбой запроса к API."""
+        if isinstance(error, ApiResponseError) and not error.is_transient:
+            # Server is reachable, the request itself is wrong, so the
+            # tenant is not retried faster but is not healthy either.
+            self.reset_failures(breaker)
+            return
+        self.failures += 1
+        self.retry_after = getattr(error, 'retry_after', None)
+        breaker.record_failure(error, self.retry_after)
+
+
+class Homework(namedtuple('Homework', ('key', 'name', 'status', 'updated'))):
+    """Домашка: ключ (id или название), название, код статуса и время."""
+
+    __slots__ = ()
+
+    @property
+    def state(self):
+        """Статус и время обновления, упакованные в одно число."""
+        return pack_state(self.status, self.updated)
+
+
+# Fetches the required fields in one call, raising KeyError on a gap.
+get_required_fields = itemgetter('homework_name', 'status')
+
+
+def pack_state(status, updated):
+    """Упаковываем код статуса и время обновления в одно число."""
+    return updated << STATUS_BITS | status
+
+
+def parse_updated(date_updated):
+    """Время обновления домашки в секундах эпохи."""
+    if not date_updated:
+        return 0
+    try:
+        return int(datetime.fromisoformat(
+            date_updated.replace('Z', '+00:00')
+        ).timestamp())
+    except (AttributeError, ValueError):
+        # Any other format is only compared for changes.
+        return zlib.crc32(str(date_updated).encode())
+
+
+def read_homework(homework):
+    """Проверяем домашку из ответа API и собираем её запись."""
+    if not isinstance(homework, dict):
+        raise TypeError(
+            f'Невалидная домашка: входящий тип данных {type(homework)}. '
+            'Ожидаемый тип данных: "dict".'
+        )
+    try:
+        name, status = get_required_fields(homework)
+    except KeyError as error:
+        raise KeyError(f'Ключ "{error.args[0]}" в домашке не обнаружен.')
+    code = STATUS_CODES.get(status)
+    if code is None:
+        raise ValueError(
+            f'Ошибка при получении ключа "{status}" из словаря вердиктов.'
+        )
+    if isinstance(name, str):
+        # Names repeat in every response, so one copy is kept.
+        name = sys.intern(name)
+    return Homework(
+        homework.get('id', name), name, code,
+        parse_updated(homework.get('date_updated'))
+    )
+
+
+def read_homeworks(response):
+    """Проверяем ответ API и за один проход собираем записи домашек."""
+    check_response(response)
+    return [read_homework(homework) for homework in response['homeworks']]
+
+
+def get_status_message(homework):
+    """Сообщение об изменении статуса домашки."""
+    return (
+        f'Изменился статус проверки работы "{homework.name}". '
+        f'{HOMEWORK_VERDICTS[STATUSES[homework.status]]}'
+    )
+
+
+class Journal:
+    """Журнал записей JSON Lines с пакетным fsync."""
+
+    def __init__(self, path, fsync_interval):
+        """Запоминаем путь журнала; файл открывает rewrite."""
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self.file = None
+        self.last_sync = time.monotonic()
+        self.lock = threading.Lock()
+
+    def read(self):
+        """Читаем все целые записи журнала."""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, encoding='utf-8') as file:
+            for line in file:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # Last line may be cut off by a crash while writing.
+                    logger.warning('Пропущена повреждённая запись: %s', line)
+
+    def rewrite(self, entries):
+        """Перезаписываем журнал снимком и открываем его для дозаписи."""
+        temp_path = f'{self.path}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            for entry in entries:
+                file.write(self._dump(entry))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, self.path)
+        self.file = open(self.path, 'a', encoding='utf-8')
+
+    def write(self, entry, flush=True):
+        """Дописываем запись, fsync выполняется не чаще интервала."""
+        with self.lock:
+            self.file.write(self._dump(entry))
+            if not flush:
+                return
+            self.file.flush()
+            if time.monotonic() - self.last_sync >= self.fsync_interval:
+                self._sync()
+
+    def sync(self):
+        """Сбрасываем журнал на диск."""
+        with self.lock:
+            self.file.flush()
+            self._sync()
+
+    def close(self):
+        """Сбрасываем журнал на диск и закрываем его."""
+        if self.file is not None and not self.file.closed:
+            self.sync()
+            self.file.close()
+
+    def _sync(self):
+        """Выполняем fsync файла журнала."""
+        os.fsync(self.file.fileno())
+        self.last_sync = time.monotonic()
+
+    @staticmethod
+    def _dump(entry):
+        """Сериализуем запись журнала в одну строку."""
+        line = json.dumps(entry, ensure_ascii=False, separators=(',', ':'))
+        return f'{line}\n'
+
+
+class StateJournal(Journal):
+    """Журнал состояния опроса: курсоры и статусы домашек."""
+
+    def __init__(self, path, fsync_interval=STATE_FSYNC_INTERVAL):
+        """Создаём журнал с интервалом fsync состояния."""
+        super().__init__(path, fsync_interval)
+
+    def load(self, store):
+        """Восстанавливаем состояние из журнала."""
+        for entry in self.read():
+            tenant_name = sys.intern(entry[1])
+            if entry[0] == 'c':
+                store.cursors[tenant_name] = entry[2]
+            else:
+                store.set(tenant_name, entry[2], entry[3])
+        logger.info(
+            'Состояние восстановлено из %s: домашек %s, курсоров %s',
+            self.path, len(store), len(store.cursors)
+        )
+
+    def compact(self, store):
+        """Перезаписываем журнал текущим снимком состояния."""
+        cursors = (
+            ('c', tenant_name, timestamp)
+            for tenant_name, timestamp in store.cursors.items()
+        )
+        states = (
+            ('h', tenant_name, homework_id, state)
+            for (tenant_name, homework_id), state in store.items()
+        )
+        self.rewrite(itertools.chain(cursors, states))
+
+
+class StateStore:
+    """LRU-хранилище последних статусов домашек всех пользователей."""
+
+    def __init__(self, max_size=STATE_STORE_SIZE, journal=None):
+        """Создаём пустое хранилище, при journal -- с журналом."""
+        self.max_size = max_size
+        # Recently used keys are moved to the end, the first one is evicted.
+        self._states = OrderedDict()
+        # Polling cursor ("from_date") of every tenant.
+        self.cursors = {}
+        self.journal = journal
+        # Tenants of a --once run are processed by several threads.
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        """Количество сохранённых домашек."""
+        return len(self._states)
+
+    def get(self, tenant_name, homework_id):
+        """Получаем упакованное состояние домашки."""
+        key = (tenant_name, homework_id)
+        with self.lock:
+            state = self._states.get(key)
+            if state is not None:
+                self._states.move_to_end(key)
+        return state
+
+    def set(self, tenant_name, homework_id, state):
+        """Сохраняем упакованное состояние домашки."""
+        key = (tenant_name, homework_id)
+        with self.lock:
+            self._states[key] = state
+            self._states.move_to_end(key)
+            if len(self._states) > self.max_size:
+                self._states.popitem(last=False)
+
+    def is_changed(self, tenant_name, homework):
+        """Проверяем, изменилась ли домашка с прошлого опроса."""
+        return self.get(tenant_name, homework.key) != homework.state
+
+    def items(self):
+        """Все сохранённые домашки от давно использованных к новым."""
+        return self._states.items()
+
+    def update(self, tenant_name, homework, flush=True):
+        """Запоминаем текущее состояние домашки."""
+        entry = (tenant_name, homework.key, homework.state)
+        self.set(*entry)
+        if self.journal is not None:
+            self.journal.write(('h', *entry), flush)
+
+    def checkpoint(self):
+        """Сбрасываем накопленные записи журнала на диск."""
+        if self.journal is not None:
+            self.journal.sync()
+
+    def save_cursor(self, tenant):
+        """Запоминаем курсор опроса пользователя."""
+        self.cursors[tenant.name] = tenant.timestamp
+        if self.journal is not None:
+            self.journal.write(('c', tenant.name, tenant.timestamp))
+
+    def restore(self, tenants):
+        """Продолжаем опрос пользователей с сохранённого состояния."""
+        by_name = {tenant.name: tenant for tenant in tenants}
+        for tenant in tenants:
+            tenant.timestamp = self.cursors.get(tenant.name, tenant.timestamp)
+        for (tenant_name, homework_id), state in self.items():
+            if state & STATUS_MASK == REVIEWING and tenant_name in by_name:
+                by_name[tenant_name].reviewing.add(homework_id)
+
+
+def open_state_store():
+    """Создаём хранилище состояния и восстанавливаем его из журнала."""
+    if not STATE_FILE:
+        return StateStore()
+    journal = StateJournal(STATE_FILE)
+    store = StateStore(journal=journal)
+    journal.load(store)
+    journal.compact(store)
+    register_shutdown(journal.close)
+    return store
+
+
+def report_startup():
+    """Печатаем время шагов запуска."""
+    sys.stderr.write('startup time: self [us] | step\n')
+    for name, duration in startup_times:
+        sys.stderr.write(f'startup time: {duration * 1e6:>9.0f} | {name}\n')
+
+
+def exit_on_sigterm():
+    """Завершаемся по SIGTERM через sys.exit: сработают finally и atexit."""
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+
+
+def register_shutdown(callback):
+    """Вызываем callback при выходе, в том числе по SIGTERM."""
+    atexit.register(callback)
+    # Let atexit hooks flush journals when the dyno is stopped.
+    exit_on_sigterm()
+
+
+def load_tenants(path):
+    """Загружаем реестр пользователей из JSON-файла или базы SQLite."""
+    logger.info('Загрузка реестра пользователей из %s', path)
+    if path.endswith(SQLITE_SUFFIXES):
+        with closing(sqlite3.connect(path)) as connection:
+            rows = connection.execute(
+                'SELECT name, practicum_token, chat_id FROM tenants'
+            ).fetchall()
+    else:
+        with open(path, encoding='utf-8') as file:
+            rows = [
+                (item['name'], item['practicum_token'], item['chat_id'])
+                for item in json.load(file)
+            ]
+    if not rows:
+        raise ValueError(f'Реестр пользователей {path} пуст.')
+    tenants = [Tenant(*row) for row in rows]
+    logger.info('Загружено пользователей: %s', len(tenants))
+    return tenants
+
+
+def get_tenants():
+    """Получаем пользователей из реестра или из переменных окружения."""
+    if TENANTS_FILE:
+        return load_tenants(TENANTS_FILE)
+    return [Tenant('default')]
 
 
 def check_tokens():
@@ -53,12 +1186,15 @@ def check_tokens():
     CHECK_VARIABLES_LIST = (
         'PRACTICUM_TOKEN', 'TELEGRAM_TOKEN', 'TELEGRAM_CHAT_ID'
     )
+    if TENANTS_FILE:
+        # Tokens and chats of tenants are taken from the registry.
+        CHECK_VARIABLES_LIST = ('TELEGRAM_TOKEN',)
     missing_tokens = [
         var for var in CHECK_VARIABLES_LIST if not globals().get(var)
     ]
     if missing_tokens:
         logger.critical(
-            f'Переменные окружения не найдены: {missing_tokens}.'
+            'Переменные окружения не найдены: %s.', missing_tokens
         )
         sys.exit(
             'Программа остановлена по причине: \nerror: empty variable(s).'
@@ -68,47 +1204,680 @@ def check_tokens():
 
 def send_message(bot, message):
     """Функция отправки сообщения в Telegram."""
+    send_chat_message(bot, TELEGRAM_CHAT_ID, message)
+
+
+def send_chat_message(bot, chat_id, message, key=None):
+    """Отправка сообщения в указанный чат Telegram."""
     logger.info('Начата отправка сообщения пользователю')
-    bot.send_message(
-        chat_id=TELEGRAM_CHAT_ID,
-        text=message
-    )
+    # Only the outbox takes the key of a status change.
+    options = {} if key is None else {'key': key}
+    with metrics.telegram_latency.time():
+        bot.send_message(
+            chat_id=chat_id,
+            text=message,
+            **options
+        )
     logger.debug('Сообщение пользователю успешно отправлено')
 
 
-def get_api_answer(timestamp):
-    """Получаем данные по API."""
-    logger.info('Попытка получения данных по API')
-    from_date = {'from_date': timestamp}
-    try:
-        response = requests.get(
-            ENDPOINT, headers=HEADERS, params=from_date
-        )
-    except requests.RequestException as error:
-        raise ConnectionError(f'Ошибка соединения: {error}')
-    if response.status_code != HTTPStatus.OK:
-        raise ValueError(
-            f'Ошибка ответа сервера - Status_code: {response.status_code}'
-        )
-    logger.info('Данные API успешно получены')
-    return response.json()
+class TokenBucket:
+    """Ведро токенов: не больше rate событий в секунду."""
 
+    def __init__(self, rate, capacity=1):
+        """Создаём полное ведро."""
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
 
-def check_response(response):
-    """Проверяем валидность данных."""
-    logger.info('Начинаем проверку входящих данных')
-    if not isinstance(response, dict):
-        raise TypeError(
-            (
-                'Невалидный ответ сервера: '
-                f'Входящий тип данных: {type(response)}. '
-                'Ожидаемый тип данных: "dict".'
-            )
+    def reserve(self):
+        """Забираем токен и возвращаем, сколько ждать до его появления."""
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated) * self.rate
         )
-    if 'homeworks'not in response:
-        raise KeyError('В ответе сервера нет ключа "homeworks".')
+        self.updated = now
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
 
-    homeworks = response.get('homeworks')
+
+class RateLimiter:
+    """Ограничение частоты отправки: общее и для каждого чата."""
+
+    def __init__(self, global_rate=SEND_GLOBAL_RATE, chat_rate=SEND_CHAT_RATE):
+        """Создаём общее ведро; вёдра чатов создаются по мере надобности."""
+        self.chat_rate = chat_rate
+        self.global_bucket = TokenBucket(global_rate, capacity=global_rate)
+        self.chat_buckets = {}
+        self.lock = threading.Lock()
+
+    def reserve(self, chat_id):
+        """Возвращаем задержку перед отправкой сообщения в чат."""
+        with self.lock:
+            bucket = self.chat_buckets.get(chat_id)
+            if bucket is None:
+                bucket = self.chat_buckets[chat_id] = TokenBucket(
+                    self.chat_rate
+                )
+            return max(self.global_bucket.reserve(), bucket.reserve())
+
+
+def get_telegram_retry_after(error):
+    """Получаем retry_after из ответа Telegram 429 Too Many Requests."""
+    if getattr(error, 'error_code', None) != HTTPStatus.TOO_MANY_REQUESTS:
+        return None
+    parameters = (error.result_json or {}).get('parameters', {})
+    return parameters.get('retry_after', 1)
+
+
+def is_permanent_send_error(error):
+    """Логируем ошибку отправки и решаем, стоит ли её повторять."""
+    logger.error(
+        'Ошибка при отправке сообщения пользователю. (queue)',
+        exc_info=True
+    )
+    return getattr(error, 'error_code', None) in PERMANENT_SEND_ERRORS
+
+
+def report_sending(sender, key, done):
+    """Сообщаем владельцу сообщения о результате отправки."""
+    if key is None:
+        return
+    callback = sender.on_done if done else sender.on_failed
+    if callback is not None:
+        callback(key)
+
+
+class MessageQueue:
+    """Очередь исходящих сообщений с фоновыми отправителями."""
+
+    def __init__(self, bot, workers=SEND_WORKERS, limiter=None):
+        """Запускаем потоки-отправители."""
+        self.bot = bot
+        self.limiter = limiter or RateLimiter()
+        # Called with the message key when it is done or must be retried.
+        self.on_done = None
+        self.on_failed = None
+        # Every chat is served by one worker, so its messages keep order.
+        self.queues = [queue.Queue() for _ in range(workers)]
+        for worker_queue in self.queues:
+            threading.Thread(
+                target=self._work, args=(worker_queue,), daemon=True
+            ).start()
+
+    def send_message(self, chat_id, text):
+        """Ставим сообщение в очередь (интерфейс как у TeleBot)."""
+        self.put(chat_id, text)
+
+    def put(self, chat_id, text, key=None):
+        """Ставим сообщение в очередь отправителя его чата."""
+        self.queues[hash(chat_id) % len(self.queues)].put(
+            (chat_id, text, key)
+        )
+        logger.debug('Сообщение поставлено в очередь на отправку')
+
+    def join(self):
+        """Ждём отправки всех сообщений из очереди."""
+        for worker_queue in self.queues:
+            worker_queue.join()
+
+    def _work(self, worker_queue):
+        """Отправляем сообщения из очереди одного отправителя."""
+        while True:
+            chat_id, text, key = worker_queue.get()
+            try:
+                report_sending(self, key, self._send(chat_id, text))
+            except Exception:
+                # The worker must outlive any message, or its chats stall.
+                logger.error('Сбой отправителя очереди', exc_info=True)
+            finally:
+                worker_queue.task_done()
+
+    def _send(self, chat_id, text):
+        """Отправляем сообщение с учётом лимитов и ответов 429."""
+        for _ in range(SEND_MAX_ATTEMPTS):
+            time.sleep(self.limiter.reserve(chat_id))
+            try:
+                with metrics.telegram_latency.time():
+                    self.bot.send_message(chat_id=chat_id, text=text)
+                logger.debug('Сообщение пользователю успешно отправлено')
+                return True
+            except apihelper.ApiException as error:
+                retry_after = get_telegram_retry_after(error)
+                if retry_after is None:
+                    return is_permanent_send_error(error)
+                logger.warning('Telegram просит подождать %s с.', retry_after)
+                time.sleep(retry_after)
+            except Exception:
+                # Network errors of the Telegram client are not
+                # ApiException; the outbox retries the message later.
+                logger.error(
+                    'Ошибка соединения при отправке сообщения. (queue)',
+                    exc_info=True
+                )
+                return False
+        logger.error(
+            'Сообщение в чат %s не отправлено: лимит попыток', chat_id
+        )
+        return False
+
+
+class AsyncMessageQueue:
+    """Асинхронная очередь исходящих сообщений."""
+
+    def __init__(self, bot, workers=SEND_WORKERS, limiter=None):
+        """Запускаем задачи-отправители."""
+        self.bot = bot
+        self.limiter = limiter or RateLimiter()
+        self.on_done = None
+        self.on_failed = None
+        self.queues = [asyncio.Queue() for _ in range(workers)]
+        self.tasks = [
+            asyncio.create_task(self._work(worker_queue))
+            for worker_queue in self.queues
+        ]
+
+    async def send_message(self, chat_id, text):
+        """Ставим сообщение в очередь (интерфейс как у AsyncTeleBot)."""
+        self.put(chat_id, text)
+
+    def put(self, chat_id, text, key=None):
+        """Ставим сообщение в очередь отправителя его чата."""
+        self.queues[hash(chat_id) % len(self.queues)].put_nowait(
+            (chat_id, text, key)
+        )
+        logger.debug('Сообщение поставлено в очередь на отправку')
+
+    async def drain(self):
+        """Отправляем оставшиеся сообщения сами, без задач-отправителей."""
+        # On shutdown asyncio.run has already cancelled the workers.
+        for worker_queue in self.queues:
+            while not worker_queue.empty():
+                chat_id, text, key = worker_queue.get_nowait()
+                report_sending(self, key, await self._send(chat_id, text))
+                worker_queue.task_done()
+
+    async def close_session(self):
+        """Останавливаем отправителей, досылаем очередь и закрываем бота."""
+        for task in self.tasks:
+            task.cancel()
+        # Homeworks of queued messages are already marked as notified.
+        await self.drain()
+        await self.bot.close_session()
+
+    async def _work(self, worker_queue):
+        """Отправляем сообщения из очереди одного отправителя."""
+        while True:
+            chat_id, text, key = await worker_queue.get()
+            try:
+                report_sending(self, key, await self._send(chat_id, text))
+            except Exception:
+                logger.error('Сбой отправителя очереди', exc_info=True)
+            finally:
+                worker_queue.task_done()
+
+    async def _send(self, chat_id, text):
+        """Отправляем сообщение с учётом лимитов и ответов 429."""
+        for _ in range(SEND_MAX_ATTEMPTS):
+            await asyncio.sleep(self.limiter.reserve(chat_id))
+            try:
+                with metrics.telegram_latency.time():
+                    await self.bot.send_message(chat_id=chat_id, text=text)
+                logger.debug('Сообщение пользователю успешно отправлено')
+                return True
+            except asyncio_helper.ApiException as error:
+                retry_after = get_telegram_retry_after(error)
+                if retry_after is None:
+                    return is_permanent_send_error(error)
+                logger.warning('Telegram просит подождать %s с.', retry_after)
+                await asyncio.sleep(retry_after)
+            except Exception:
+                # Network errors of the Telegram client are not
+                # ApiException; the outbox retries the message later.
+                logger.error(
+                    'Ошибка соединения при отправке сообщения. (queue)',
+                    exc_info=True
+                )
+                return False
+        logger.error(
+            'Сообщение в чат %s не отправлено: лимит попыток', chat_id
+        )
+        return False
+
+
+def get_idempotency_key(chat_id, text):
+    """Ключ сообщения без статуса домашки (об ошибке): чат и текст."""
+    return hashlib.sha1(f'{chat_id}:{text}'.encode()).hexdigest()
+
+
+def get_status_key(bot, tenant, homework):
+    """Ключ изменения статуса для outbox: одно изменение - одна отправка."""
+    if not isinstance(bot, Outbox):
+        return None
+    # The packed state holds the update time, so a status that comes
+    # back later is a new change even though its text is the same.
+    return hashlib.sha1(
+        f'{tenant.name}:{homework.key}:{homework.state}'.encode()
+    ).hexdigest()
+
+
+class Outbox:
+    """Персистентная очередь исходящих сообщений: доставка хотя бы раз."""
+
+    def __init__(
+        self, sender, path, flush_interval=OUTBOX_FLUSH_INTERVAL,
+        retry_interval=OUTBOX_RETRY_INTERVAL
+    ):
+        """Подключаемся к отправителю и открываем журнал outbox."""
+        self.sender = sender
+        self.retry_interval = retry_interval
+        self.journal = Journal(path, flush_interval)
+        # Undelivered messages by key and retry times of failed ones.
+        self.pending = {}
+        self.failed = {}
+        self.lock = threading.Lock()
+        sender.on_done = self.ack
+        sender.on_failed = self.fail
+
+    def __len__(self):
+        """Количество недоставленных сообщений."""
+        return len(self.pending)
+
+    def load(self):
+        """Восстанавливаем недоставленные сообщения и отправляем их."""
+        for entry in self.journal.read():
+            if entry[0] == 'a':
+                self.pending[entry[1]] = (entry[2], entry[3])
+            else:
+                self.pending.pop(entry[1], None)
+        self.journal.rewrite(
+            ('a', key, *message) for key, message in self.pending.items()
+        )
+        for key, (chat_id, text) in self.pending.items():
+            self.sender.put(chat_id, text, key)
+        logger.info('Недоставленных сообщений в outbox: %s', len(self))
+
+    def send_message(self, chat_id, text, key=None):
+        """Сохраняем сообщение и ставим его в очередь отправки."""
+        key = key or get_idempotency_key(chat_id, text)
+        with self.lock:
+            if key in self.pending:
+                logger.debug('Сообщение уже ожидает отправки в outbox')
+                return
+            self.pending[key] = (chat_id, text)
+        # Handed to the OS before the state journal marks the homework
+        # as notified; only the fsync is batched by maintain().
+        self.journal.write(('a', key, chat_id, text))
+        self.sender.put(chat_id, text, key)
+
+    def ack(self, key):
+        """Сообщение доставлено: убираем его из outbox."""
+        with self.lock:
+            self.pending.pop(key, None)
+            self.failed.pop(key, None)
+        self.journal.write(('d', key), flush=False)
+
+    def fail(self, key):
+        """Сообщение не доставлено: повторим его позже."""
+        with self.lock:
+            self.failed[key] = time.monotonic() + self.retry_interval
+
+    def maintain(self):
+        """Сбрасываем журнал на диск и повторяем недоставленные сообщения."""
+        self.journal.sync()
+        now = time.monotonic()
+        with self.lock:
+            due = [key for key, at in self.failed.items() if at <= now]
+            for key in due:
+                del self.failed[key]
+            retries = [
+                (key, self.pending[key]) for key in due if key in self.pending
+            ]
+        for key, (chat_id, text) in retries:
+            self.sender.put(chat_id, text, key)
+
+    def run(self):
+        """Фоновое обслуживание outbox в отдельном потоке."""
+        while True:
+            time.sleep(self.journal.fsync_interval)
+            self.maintain()
+
+    def close(self):
+        """Сбрасываем журнал outbox на диск."""
+        self.journal.close()
+
+
+class AsyncOutbox(Outbox):
+    """Персистентная очередь исходящих сообщений асинхронного движка."""
+
+    async def send_message(self, chat_id, text, key=None):
+        """Сохраняем сообщение и ставим его в очередь отправки."""
+        super().send_message(chat_id, text, key)
+
+    async def run(self):
+        """Фоновое обслуживание outbox в задаче asyncio."""
+        while True:
+            await asyncio.sleep(self.journal.fsync_interval)
+            self.maintain()
+
+    async def close_session(self):
+        """Останавливаем отправителей и сбрасываем журнал."""
+        await self.sender.close_session()
+        self.close()
+
+
+def format_digest(items):
+    """Собираем сообщения в сводки не длиннее лимита Telegram.
+
+    Принимает пары (текст, ключ outbox), возвращает пары (сводка, ключи).
+    """
+    if len(items) < 2:
+        return [(text, [key]) for text, key in items]
+    digests = []
+    digest, keys = f'Сводка обновлений: {len(items)}', []
+    for text, key in items:
+        if len(digest) + len(text) + 2 > TELEGRAM_MESSAGE_LIMIT:
+            digests.append((digest, keys))
+            digest, keys = text, []
+        else:
+            digest += '\n\n' + text
+        keys.append(key)
+    digests.append((digest, keys))
+    return digests
+
+
+class Digest:
+    """Сводка: сообщения чата за окно после отправки -- одним сообщением.
+
+    Стоит за outbox и перед очередью отправки: outbox сохраняет каждое
+    сообщение до того, как оно попадёт в сводку.
+    """
+
+    def __init__(self, sender, window=DIGEST_WINDOW):
+        """Подключаемся к отправителю; окна чатов пока закрыты."""
+        self.sender = sender
+        self.window = window
+        # Called by the outbox API with every message key of a digest.
+        self.on_done = None
+        self.on_failed = None
+        if self.is_queue():
+            sender.on_done = self.done
+            sender.on_failed = self.failed
+        # Messages and their keys collected in the open window of every
+        # chat; a chat without an entry is idle and gets the next one now.
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.deadlines = []
+        self.sequence = itertools.count()
+
+    def is_queue(self):
+        """Отправляем ли мы через очередь, а не прямо боту."""
+        return isinstance(self.sender, (MessageQueue, AsyncMessageQueue))
+
+    def done(self, keys):
+        """Сводка доставлена: сообщаем о каждом её сообщении."""
+        for key in keys:
+            report_sending(self, key, True)
+
+    def failed(self, keys):
+        """Сводка не доставлена: каждое её сообщение будет повторено."""
+        for key in keys:
+            report_sending(self, key, False)
+
+    def buffer(self, chat_id, text, key):
+        """Копим сообщение в открытом окне; False, если чат простаивал."""
+        with self.lock:
+            items = self.pending.get(chat_id)
+            if items is not None:
+                items.append((text, key))
+                logger.debug('Сообщение отложено в сводку')
+                return True
+            self.pending[chat_id] = []
+            self.schedule(chat_id)
+        return False
+
+    def close_window(self, chat_id):
+        """Забираем сводки окна; если они есть, открываем следующее."""
+        with self.lock:
+            items = self.pending.pop(chat_id, [])
+            if items:
+                self.pending[chat_id] = []
+                self.schedule(chat_id)
+        return format_digest(items)
+
+    def get_due_chats(self):
+        """Чаты, у которых накопились сообщения."""
+        with self.lock:
+            return [
+                chat_id for chat_id, items in self.pending.items() if items
+            ]
+
+    def schedule(self, chat_id):
+        """Назначаем конец окна чата."""
+        heapq.heappush(self.deadlines, (
+            time.monotonic() + self.window, next(self.sequence), chat_id
+        ))
+        self.wakeup.notify()
+
+    def forward(self, chat_id, text, keys):
+        """Ставим сообщение или сводку в очередь отправки."""
+        keys = [key for key in keys if key is not None]
+        self.sender.put(chat_id, text, keys or None)
+
+    def deliver(self, chat_id, text, keys):
+        """Передаём сообщение дальше: в очередь или прямо боту."""
+        if self.is_queue():
+            self.forward(chat_id, text, keys)
+        else:
+            self.sender.send_message(chat_id=chat_id, text=text)
+
+    def put(self, chat_id, text, key=None):
+        """Отправляем сообщение сразу или копим его в сводку."""
+        if not self.buffer(chat_id, text, key):
+            self.deliver(chat_id, text, [key])
+
+    def send_message(self, chat_id, text):
+        """Отправляем сообщение сразу или копим его в сводку."""
+        self.put(chat_id, text)
+
+    def flush(self, chat_id):
+        """Отправляем сводку чата по окончании окна."""
+        for digest, keys in self.close_window(chat_id):
+            try:
+                self.deliver(chat_id, digest, keys)
+            except Exception:
+                # Any error of the bot, or the window thread would die.
+                logger.error(
+                    'Сводка в чат %s не отправлена', chat_id, exc_info=True
+                )
+
+    def flush_all(self):
+        """Отправляем все накопленные сводки, не дожидаясь конца окон."""
+        for chat_id in self.get_due_chats():
+            self.flush(chat_id)
+
+    def close(self):
+        """Отправляем накопленные сводки и ждём их доставки."""
+        self.flush_all()
+        if isinstance(self.sender, MessageQueue):
+            # Sender threads are daemons and die right after atexit.
+            self.sender.join()
+
+    def run(self):
+        """Закрываем окна чатов в фоновом потоке."""
+        while True:
+            with self.wakeup:
+                while (
+                    not self.deadlines
+                    or self.deadlines[0][0] > time.monotonic()
+                ):
+                    self.wakeup.wait(
+                        self.deadlines[0][0] - time.monotonic()
+                        if self.deadlines else None
+                    )
+                _, _, chat_id = heapq.heappop(self.deadlines)
+            self.flush(chat_id)
+
+
+class AsyncDigest(Digest):
+    """Сводка сообщений для движка asyncio."""
+
+    def __init__(self, sender, window=DIGEST_WINDOW):
+        """Создаём сводку без задач закрытия окон."""
+        super().__init__(sender, window)
+        self.tasks = set()
+
+    def schedule(self, chat_id):
+        """Закрываем окно чата задачей asyncio."""
+        task = asyncio.create_task(self.wait_and_flush(chat_id))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def put(self, chat_id, text, key=None):
+        """Копим сообщение outbox или ставим его в очередь."""
+        if not self.buffer(chat_id, text, key):
+            self.forward(chat_id, text, [key])
+
+    async def deliver(self, chat_id, text, keys):
+        """Передаём сообщение дальше: в очередь или прямо боту."""
+        if self.is_queue():
+            self.forward(chat_id, text, keys)
+        else:
+            await self.sender.send_message(chat_id=chat_id, text=text)
+
+    async def send_message(self, chat_id, text):
+        """Отправляем сообщение сразу или копим его в сводку."""
+        if not self.buffer(chat_id, text, None):
+            await self.deliver(chat_id, text, [])
+
+    async def flush(self, chat_id):
+        """Отправляем сводку чата."""
+        for digest, keys in self.close_window(chat_id):
+            try:
+                await self.deliver(chat_id, digest, keys)
+            except Exception:
+                logger.error(
+                    'Сводка в чат %s не отправлена', chat_id, exc_info=True
+                )
+
+    async def wait_and_flush(self, chat_id):
+        """Отправляем сводку чата по окончании окна."""
+        await asyncio.sleep(self.window)
+        await self.flush(chat_id)
+
+    async def close_session(self):
+        """Отправляем накопленные сводки и закрываем отправителя."""
+        for chat_id in self.get_due_chats():
+            await self.flush(chat_id)
+        for task in list(self.tasks):
+            task.cancel()
+        await self.sender.close_session()
+
+
+def add_outbox_gauge(outbox):
+    """Публикуем глубину outbox в метриках."""
+    metrics.add_gauge(
+        'homework_outbox_depth', 'Недоставленные сообщения в outbox.',
+        lambda: [('', len(outbox))]
+    )
+
+
+def create_sender(bot):
+    """Оборачиваем бота очередью отправки, сводкой и outbox."""
+    sender = bot
+    if OUTBOX_FILE or SEND_QUEUE:
+        sender = MessageQueue(bot)
+        if not OUTBOX_FILE:
+            # Without an outbox queued messages exist only in memory, and
+            # the sender threads are daemons.
+            register_shutdown(sender.join)
+    if DIGEST_WINDOW:
+        sender = Digest(sender)
+        threading.Thread(target=sender.run, daemon=True).start()
+        if not OUTBOX_FILE:
+            # Without an outbox collected messages exist only in memory.
+            register_shutdown(sender.close)
+    if OUTBOX_FILE:
+        outbox = Outbox(sender, OUTBOX_FILE)
+        outbox.load()
+        add_outbox_gauge(outbox)
+        register_shutdown(outbox.close)
+        threading.Thread(target=outbox.run, daemon=True).start()
+        return outbox
+    return sender
+
+
+def create_async_sender(bot):
+    """Асинхронный вариант create_sender."""
+    sender = bot
+    if OUTBOX_FILE or SEND_QUEUE or DIGEST_WINDOW:
+        # Queued messages and collected digests are sent by close_session
+        # in async_main, which SIGTERM must reach.
+        exit_on_sigterm()
+    if OUTBOX_FILE or SEND_QUEUE:
+        sender = AsyncMessageQueue(bot)
+    if DIGEST_WINDOW:
+        sender = AsyncDigest(sender)
+    if OUTBOX_FILE:
+        outbox = AsyncOutbox(sender, OUTBOX_FILE)
+        outbox.load()
+        add_outbox_gauge(outbox)
+        register_shutdown(outbox.close)
+        outbox.task = asyncio.create_task(outbox.run())
+        return outbox
+    return sender
+
+
+def get_api_answer(timestamp):
+    """Получаем данные по API."""
+    return request_api_answer(timestamp, HEADERS)
+
+
+def request_api_answer(timestamp, headers):
+    """Получаем данные по API с заголовками пользователя."""
+    return fetch_api_response(timestamp, headers).json()
+
+
+def fetch_api_response(timestamp, headers):
+    """Запрос к API: ответ со статусом 200 или 304."""
+    logger.info('Попытка получения данных по API')
+    from_date = {'from_date': timestamp}
+    try:
+        with metrics.api_latency.time():
+            response = get_api_client().get(
+                ENDPOINT, headers=headers, params=from_date,
+                timeout=(API_CONNECT_TIMEOUT, API_READ_TIMEOUT)
+            )
+    except requests.RequestException as error:
+        raise ConnectionError(f'Ошибка соединения: {error}')
+    if response.status_code not in (HTTPStatus.OK, HTTPStatus.NOT_MODIFIED):
+        raise ApiResponseError(
+            response.status_code,
+            parse_retry_after(response.headers.get('Retry-After'))
+        )
+    logger.info('Данные API успешно получены')
+    return response
+
+
+def check_response(response):
+    """Проверяем валидность данных."""
+    logger.info('Начинаем проверку входящих данных')
+    if not isinstance(response, dict):
+        raise TypeError(
+            (
+                'Невалидный ответ сервера: '
+                f'Входящий тип данных: {type(response)}. '
+                'Ожидаемый тип данных: "dict".'
+            )
+        )
+    if 'homeworks'not in response:
+        raise KeyError('В ответе сервера нет ключа "homeworks".')
+
+    homeworks = response.get('homeworks')
 
     if not isinstance(homeworks, list):
         raise TypeError(
@@ -124,76 +1893,1327 @@ def check_response(response):
 def parse_status(response):
     """Получаем нужную информацию из ответа."""
     logger.info('Попытка получения статуса домашки')
-    if 'status' not in response:
-        raise KeyError('Ключ "status" в домашке не обнаружен.')
-    if 'homework_name' not in response:
-        raise KeyError('Ключ "homework_name" в домашке не обнаружен.')
+    message = get_status_message(read_homework(response))
+    logger.info(message)
+    return message
+
+
+def deliver(bot, tenant, message, key=None):
+    """Отправляем сообщение в чат пользователя."""
+    if tenant.chat_id is None and key is None:
+        send_message(bot, message)
+    else:
+        send_chat_message(
+            bot, tenant.chat_id or TELEGRAM_CHAT_ID, message, key
+        )
+
 
-    homework_status = response['status']
-    homework_name = response['homework_name']
+def notify(bot, tenant, message):
+    """Отправляем сообщение об ошибке, если оно ещё не отправлялось."""
+    if message == tenant.last_error:
+        logger.info(
+            'Отмена отправки сообщения, данное сообщение '
+            'уже было отправлено: \n"%s"', message
+        )
+        return
+    deliver(bot, tenant, message)
+    tenant.last_error = message
 
-    if homework_status not in HOMEWORK_VERDICTS:
+
+def process_homeworks(bot, tenant, homeworks, store):
+    """Отправляем изменившиеся статусы всех домашек из ответа."""
+    # API lists the most recently updated homework first.
+    for homework in reversed(homeworks):
+        tenant.track_review(homework)
+        if not store.is_changed(tenant.name, homework):
+            logger.debug('Статус домашки не изменился.')
+            continue
+        message = get_status_message(homework)
+        logger.info(message)
+        deliver(bot, tenant, message, get_status_key(bot, tenant, homework))
+        store.update(tenant.name, homework)
+
+
+def request_tenant_answer(tenant, breaker):
+    """Запрос к API через размыкатель цепи с учётом сбоев."""
+    try:
+        response = fetch_api_response(
+            tenant.timestamp, tenant.cache.get_headers(tenant.headers)
+        )
+    except (ConnectionError, ApiResponseError) as error:
+        tenant.record_api_failure(breaker, error)
+        raise
+    tenant.record_api_success(breaker)
+    if response.status_code == HTTPStatus.NOT_MODIFIED:
+        return None
+    # Transports other than requests may expose neither headers nor
+    # the raw body; such responses are always decoded.
+    body = getattr(response, 'content', None)
+    if tenant.cache.is_unchanged(
+        getattr(response, 'headers', None) or {}, body
+    ):
+        return None
+    return response.json() if body is None else json_loads(body)
+
+
+def is_api_paused(breaker):
+    """Проверяем, не приостановлен ли опрос размыкателем цепи."""
+    if breaker.allow_request():
+        return False
+    logger.warning('Опрос API приостановлен: %s', breaker.get_status())
+    return True
+
+
+def poll_tenant(bot, tenant, store, breaker):
+    """Опрашиваем API для одного пользователя и отправляем статус.
+
+    Возвращает True при успехе, False при сбое и None, если пользователя
+    опрашивает другой процесс.
+    """
+    if not tenant.active:
+        return None
+    if is_api_paused(breaker):
+        return False
+    try:
+        response = request_tenant_answer(tenant, breaker)
+        if response is None:
+            logger.debug('Ответ API не изменился с прошлого опроса.')
+        else:
+            homeworks = read_homeworks(response)
+            if homeworks:
+                with tenant.lock:
+                    process_homeworks(bot, tenant, homeworks, store)
+                tenant.timestamp = response.get(
+                    'current_date', int(time.time())
+                )
+                store.save_cursor(tenant)
+            else:
+                logger.debug('Список с домашками пуст.')
+            tenant.cache.commit()
+        # The outage is over, so the same error later is news again.
+        tenant.last_error = ''
+        return True
+    except apihelper.ApiException as error:
+        metrics.poll_errors.inc(type(error).__name__)
+        logger.error(
+            'Ошибка при отправке сообщения пользователю. (main)',
+            exc_info=True
+        )
+    except Exception as error:
+        metrics.poll_errors.inc(type(error).__name__)
+        message = f'Сбой в работе программы: {error}'
+        logger.error(message, exc_info=True)
+        try:
+            notify(bot, tenant, message)
+        except apihelper.ApiException:
+            logger.error(
+                'Ошибка при отправке сообщения пользователю. (main)',
+                exc_info=True
+            )
+    return False
+
+
+class WebhookError(Exception):
+    """Событие webhook отклонено."""
+
+    def __init__(self, status, message):
+        """Запоминаем HTTP-код ответа."""
+        super().__init__(message)
+        self.status = status
+
+
+def parse_webhook_event(tenants, path, secret, body):
+    """Проверяем событие webhook и находим его пользователя."""
+    if WEBHOOK_SECRET and not hmac.compare_digest(
+        secret or '', WEBHOOK_SECRET
+    ):
+        raise WebhookError(HTTPStatus.FORBIDDEN, 'Неверный секрет webhook.')
+    tenant = None
+    if path.startswith(WEBHOOK_PATH):
+        tenant = tenants.get(path[len(WEBHOOK_PATH):])
+    if tenant is None:
+        raise WebhookError(HTTPStatus.NOT_FOUND, 'Пользователь не найден.')
+    if not tenant.leased:
+        # The sender retries, and the balancer picks another node.
+        raise WebhookError(
+            HTTPStatus.SERVICE_UNAVAILABLE,
+            'Пользователя обслуживает другой узел.'
+        )
+    try:
+        homeworks = read_homeworks(json_loads(body))
+    except (ValueError, TypeError, KeyError) as error:
+        raise WebhookError(HTTPStatus.BAD_REQUEST, str(error))
+    return tenant, homeworks
+
+
+def get_body_length(value):
+    """Проверяем длину тела события webhook из Content-Length."""
+    try:
+        length = int(value or 0)
+    except ValueError:
+        length = -1
+    if length < 0:
+        raise WebhookError(HTTPStatus.BAD_REQUEST, 'Неверный Content-Length.')
+    if length > WEBHOOK_MAX_BODY:
+        raise WebhookError(
+            HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+            f'Событие webhook больше {WEBHOOK_MAX_BODY} байт.'
+        )
+    return length
+
+
+def check_webhook_settings():
+    """Не принимаем события извне без секрета."""
+    if WEBHOOK_HOST not in LOOPBACK_HOSTS and not WEBHOOK_SECRET:
         raise ValueError(
-            f'Ошибка при получении ключа "{homework_status}" '
-            'из словаря вердиктов.'
+            f'Для приёма webhook на {WEBHOOK_HOST} нужен WEBHOOK_SECRET.'
         )
-    verdict = HOMEWORK_VERDICTS.get(homework_status)
-    message = (
-        f'Изменился статус проверки работы "{homework_name}". '
-        f'{verdict}'
-    )
-    logger.info(message)
-    return message
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    """Приём событий о статусах домашек по HTTP."""
+
+    def do_POST(self):
+        """Обрабатываем событие в формате ответа API."""
+        try:
+            length = get_body_length(self.headers.get('Content-Length'))
+        except WebhookError as error:
+            logger.warning('Событие webhook отклонено: %s', error)
+            # The unread body must not be taken for the next request.
+            self.close_connection = True
+            self.respond(error.status, str(error))
+            return
+        # Tenants are matched like in aiohttp: no query, decoded path.
+        status, text = self.server.ingest(
+            unquote(urlsplit(self.path).path),
+            self.headers.get('X-Webhook-Secret'), self.rfile.read(length)
+        )
+        self.respond(status, text)
+
+    def respond(self, status, text):
+        """Отправляем ответ текстом."""
+        payload = text.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        """Пишем журнал запросов в лог бота."""
+        logger.debug(format, *args)
+
+
+class WebhookServer(ThreadingHTTPServer):
+    """HTTP-приёмник событий, передающий их в обработку домашек."""
+
+    daemon_threads = True
+
+    def __init__(self, bot, tenants, store):
+        """Открываем порт приёма событий."""
+        super().__init__((WEBHOOK_HOST, WEBHOOK_PORT), WebhookHandler)
+        self.bot = bot
+        self.tenants = {tenant.name: tenant for tenant in tenants}
+        self.store = store
+
+    def ingest(self, path, secret, body):
+        """Отправляем изменившиеся статусы из события."""
+        try:
+            tenant, homeworks = parse_webhook_event(
+                self.tenants, path, secret, body
+            )
+            with tenant.lock:
+                process_homeworks(self.bot, tenant, homeworks, self.store)
+        except WebhookError as error:
+            logger.warning('Событие webhook отклонено: %s', error)
+            return error.status, str(error)
+        except Exception as error:
+            logger.error('Сбой обработки webhook: %s', error, exc_info=True)
+            return HTTPStatus.INTERNAL_SERVER_ERROR, str(error)
+        return HTTPStatus.OK, 'ok'
+
+
+def start_webhook_server(bot, tenants, store):
+    """Запускаем приёмник webhook в фоновом потоке, если он включен."""
+    if not WEBHOOK_PORT:
+        return None
+    check_webhook_settings()
+    server = WebhookServer(bot, tenants, store)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info('Приём webhook на %s:%s', WEBHOOK_HOST, WEBHOOK_PORT)
+    return server
+
+
+class HomeworkStream:
+    """Потоковый разбор массива homeworks из тела ответа API."""
+
+    def __init__(self, chunks):
+        """Готовим разбор кусков тела ответа."""
+        self.chunks = iter(chunks)
+        self.text = codecs.getincrementaldecoder('utf-8')()
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.position = 0
+        self.current_date = None
+
+    def __iter__(self):
+        """Отдаём домашки по одной, не загружая весь ответ в память."""
+        start = self.find(HOMEWORKS_START_PATTERN)
+        if start is None:
+            raise KeyError('В ответе сервера нет ключа "homeworks".')
+        self.find_current_date(self.buffer[self.position:start.start()])
+        self.position = start.end()
+        while self.skip_separators() != ']':
+            try:
+                homework, self.position = self.decoder.raw_decode(
+                    self.buffer, self.position
+                )
+            except json.JSONDecodeError:
+                # The homework is cut by the end of the chunk.
+                if not self.read():
+                    raise
+                continue
+            yield homework
+        self.position += 1
+        while self.read():
+            pass
+        self.find_current_date(self.buffer[self.position:])
+
+    def read(self):
+        """Дочитываем следующий кусок тела, False в конце тела."""
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            return False
+        # Parsed text is dropped, so the buffer holds about one chunk.
+        self.buffer = self.buffer[self.position:] + self.text.decode(chunk)
+        self.position = 0
+        return True
+
+    def find(self, pattern):
+        """Ищем шаблон, дочитывая тело по мере надобности."""
+        while True:
+            match = pattern.search(self.buffer, self.position)
+            if match is not None or not self.read():
+                return match
+
+    def skip_separators(self):
+        """Пропускаем пробелы и запятые до следующего элемента."""
+        while True:
+            while (
+                self.position < len(self.buffer)
+                and self.buffer[self.position] in ' \t\r\n,'
+            ):
+                self.position += 1
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self.read():
+                raise ValueError('Ответ API оборвался внутри "homeworks".')
+
+    def find_current_date(self, text):
+        """Запоминаем current_date, если он есть в тексте."""
+        match = CURRENT_DATE_FIELD_PATTERN.search(text)
+        if match is not None:
+            self.current_date = int(match.group(1))
+
+
+def request_api_stream(timestamp, headers):
+    """Запрос к API с потоковым чтением тела ответа."""
+    logger.info('Попытка потокового получения данных по API')
+    try:
+        response = get_api_client().get(
+            ENDPOINT, headers=headers, params={'from_date': timestamp},
+            timeout=(API_CONNECT_TIMEOUT, API_READ_TIMEOUT), stream=True
+        )
+    except requests.RequestException as error:
+        raise ConnectionError(f'Ошибка соединения: {error}')
+    if response.status_code != HTTPStatus.OK:
+        response.close()
+        raise ApiResponseError(
+            response.status_code,
+            parse_retry_after(response.headers.get('Retry-After'))
+        )
+    return response
+
+
+def backfill_tenant(tenant, store):
+    """Заполняем состояние пользователя всей историей без уведомлений."""
+    logger.info('Заполнение истории пользователя %s', tenant.name)
+    count = 0
+    with closing(request_api_stream(0, tenant.headers)) as response:
+        stream = HomeworkStream(response.iter_content(BACKFILL_CHUNK_SIZE))
+        for count, homework in enumerate(map(read_homework, stream), 1):
+            tenant.track_review(homework)
+            if store.is_changed(tenant.name, homework):
+                store.update(tenant.name, homework, flush=False)
+            if count % BACKFILL_CHECKPOINT == 0:
+                store.checkpoint()
+                logger.info(
+                    'Пользователь %s: обработано домашек %s',
+                    tenant.name, count
+                )
+    tenant.timestamp = stream.current_date or int(time.time())
+    store.save_cursor(tenant)
+    store.checkpoint()
+    return count
+
+
+def backfill(names=None):
+    """Заполняем состояние по всей истории домашек без уведомлений."""
+    if not STATE_FILE:
+        sys.exit('Для заполнения истории задайте STATE_FILE.')
+    init_api_client()
+    tenants = get_tenants()
+    store = open_state_store()
+    store.restore(tenants)
+    if names:
+        tenants = [tenant for tenant in tenants if tenant.name in names]
+    failed = []
+    for tenant in tenants:
+        try:
+            count = backfill_tenant(tenant, store)
+        except Exception as error:
+            logger.error(
+                'Сбой заполнения истории пользователя %s: %s',
+                tenant.name, error, exc_info=True
+            )
+            failed.append(tenant.name)
+            continue
+        logger.info(
+            'История пользователя %s заполнена: домашек %s',
+            tenant.name, count
+        )
+    if failed:
+        sys.exit(f'Не удалось заполнить историю пользователей: {failed}')
+
+
+def get_sleep_time(tenants):
+    """Время ожидания до ближайшего опроса."""
+    if ADAPTIVE_POLLING:
+        next_poll = min(tenant.next_poll for tenant in tenants)
+        return max(next_poll - time.monotonic(), 0)
+    # Fixed period, shortened only by retries of failed requests.
+    retries = [
+        tenant.next_poll for tenant in tenants
+        if tenant.failures or not tenant.active
+    ]
+    if not retries:
+        return RETRY_PERIOD
+    return max(min(min(retries) - time.monotonic(), RETRY_PERIOD), 0)
+
+
+def stable_hash(text):
+    """Хеш строки, одинаковый во всех процессах и при перезапусках."""
+    digest = hashlib.sha1(text.encode()).digest()
+    return int.from_bytes(digest[:8], 'big')
+
+
+class PeriodScheduler:
+    """Опрос всех пользователей раз в RETRY_PERIOD."""
+
+    def __init__(self, tenants):
+        """Регистрируем метрику плана опросов."""
+        self.tenants = tenants
+        metrics.add_gauge(
+            'homework_planned_polls',
+            'Запланированные опросы API по отрезкам ближайшего периода.',
+            self.collect_planned_load
+        )
+
+    def first_deadline(self, tenant):
+        """Срок первого опроса пользователя."""
+        return time.monotonic()
+
+    def fire_time(self, deadline):
+        """Момент, когда опрос со сроком deadline действительно начнётся."""
+        return deadline
+
+    def planned_load(self, buckets=PLAN_BUCKETS):
+        """Число опросов по равным отрезкам ближайшего периода."""
+        now = time.monotonic()
+        horizon = max(tenant.interval for tenant in self.tenants) or 1
+        width = horizon / buckets
+        load = [0] * buckets
+        for tenant in self.tenants:
+            planned = max(tenant.next_poll, now)
+            while planned < now + horizon:
+                load[int((planned - now) / width)] += 1
+                if tenant.interval <= 0:
+                    break
+                planned += tenant.interval
+        return width, load
+
+    def collect_planned_load(self):
+        """План нагрузки в виде значений метрики."""
+        width, load = self.planned_load()
+        return [
+            (f'{{offset="{round(index * width, 3)}"}}', count)
+            for index, count in enumerate(load)
+        ]
+
+    def poll_due(self, bot, store, breaker):
+        """Опрашиваем пользователей, которым пора, и считаем паузу."""
+        for tenant in self.tenants:
+            if tenant.is_due():
+                poll_tenant(bot, tenant, store, breaker)
+                tenant.schedule_next_poll()
+        return get_sleep_time(self.tenants)
+
+    def advance(self, tenant, deadline):
+        """Срок следующего опроса пользователя."""
+        tenant.schedule_next_poll()
+        return tenant.next_poll
+
+
+class DeadlineScheduler(PeriodScheduler):
+    """Опрос по срокам на монотонных часах, без накопления дрейфа."""
+
+    def __init__(self, tenants):
+        """Назначаем первые сроки опроса всех пользователей."""
+        super().__init__(tenants)
+        # Heap of (fire time, position, deadline, tenant): position
+        # breaks ties so tenants themselves are never compared. An entry
+        # whose deadline is not the tenant's next_poll is outdated.
+        self.deadlines = []
+        self.positions = itertools.count(len(tenants))
+        # Tenants handed over by other threads, pushed by the poll loop.
+        self.resets = queue.SimpleQueue()
+        for position, tenant in enumerate(tenants):
+            tenant.next_poll = self.first_deadline(tenant)
+            tenant.on_reset = self.resets.put
+            self.push(position, tenant.next_poll, tenant)
+
+    def push(self, position, deadline, tenant):
+        """Ставим опрос пользователя в очередь по сроку."""
+        heapq.heappush(
+            self.deadlines,
+            (self.fire_time(deadline), position, deadline, tenant)
+        )
+
+    def first_deadline(self, tenant):
+        """Первый опрос сдвигаем на фазу пользователя внутри периода."""
+        now = time.monotonic()
+        if not POLL_STAGGER or not tenant.active:
+            return now
+        # The same token always lands on the same phase, so restarts
+        # and several instances keep the load spread out.
+        fraction = stable_hash(tenant.headers['Authorization']) / 2 ** 64
+        return now + fraction * tenant.interval
+
+    def fire_time(self, deadline):
+        """Добавляем к сроку случайный разброс POLL_JITTER."""
+        return deadline + random.uniform(0, POLL_JITTER)
+
+    def poll_due(self, bot, store, breaker):
+        """Опрашиваем пользователей с наступившим сроком."""
+        now = time.monotonic()
+        while not self.resets.empty():
+            tenant = self.resets.get()
+            self.push(next(self.positions), tenant.next_poll, tenant)
+        while self.deadlines and self.deadlines[0][0] <= now:
+            _, position, deadline, tenant = heapq.heappop(self.deadlines)
+            if deadline != tenant.next_poll:
+                continue
+            poll_tenant(bot, tenant, store, breaker)
+            self.push(position, self.advance(tenant, deadline), tenant)
+        return max(self.deadlines[0][0] - time.monotonic(), 0)
+
+    def advance(self, tenant, deadline):
+        """Следующий срок отсчитываем от прошлого срока, а не от now."""
+        interval = tenant.schedule_next_poll()
+        if tenant.failures:
+            # Retries back off from the moment of the failure.
+            return tenant.next_poll
+        now = time.monotonic()
+        deadline += interval
+        if deadline <= now and interval > 0:
+            missed = math.ceil((now - deadline) / interval)
+            metrics.poll_overruns.inc()
+            logger.warning(
+                'Опрос пользователя %s не уложился в период, '
+                'пропущено сроков: %s', tenant.name, missed
+            )
+            deadline += missed * interval
+        tenant.next_poll = max(deadline, now)
+        return tenant.next_poll
+
+
+def create_scheduler(tenants):
+    """Создаём планировщик опросов по настройке SCHEDULER."""
+    if SCHEDULER not in SCHEDULERS:
+        raise ValueError(f'Неизвестный планировщик опросов: {SCHEDULER}')
+    if SCHEDULER == 'deadline':
+        return DeadlineScheduler(tenants)
+    return PeriodScheduler(tenants)
 
 
 def main():
     """Основная логика работы бота."""
     check_tokens()
-    sended_message = ''
+    init_api_client()
+    init_telegram_api(apihelper)
     bot = TeleBot(token=TELEGRAM_TOKEN)
-    timestamp = int(time.time())
+    bot = create_sender(bot)
+    tenants = get_tenants()
+    store = open_state_store()
+    store.restore(tenants)
+    start_ownership(tenants, store)
+    breaker = CircuitBreaker()
+    start_webhook_server(bot, tenants, store)
+    start_metrics_server(tenants, breaker)
+    scheduler = create_scheduler(tenants)
     while True:
-        try:
-            response = get_api_answer(timestamp)
-            check_response(response)
-            homework = response['homeworks']
-            if not homework:
-                logger.debug('Список с домашками пуст.')
-                continue
-            message = parse_status(homework[HOMEWORK_NUMBER])
-            if message not in sended_message:
-                send_message(bot, message)
-                sended_message = message
-            else:
-                logger.info(
-                    'Отмена отправки сообщения, данное сообщение '
-                    'уже было отправлено: \n'
-                    f'"{message}"'
+        delay = scheduler.poll_due(bot, store, breaker)
+        logger.info('Ожидание следующего запроса -- %s секунд.', delay)
+        started = time.monotonic()
+        time.sleep(delay)
+        metrics.sleep_drift.observe(time.monotonic() - started - delay)
+
+
+async def async_get_api_answer(
+    session, timestamp, headers=HEADERS, cache=None
+):
+    """Асинхронно получаем данные по API.
+
+    С кешем ответа возвращает None, если данные не изменились.
+    """
+    logger.info('Попытка получения данных по API')
+    from_date = {'from_date': timestamp}
+    if cache is not None:
+        headers = cache.get_headers(headers)
+    try:
+        with metrics.api_latency.time():
+            async with session.get(
+                ENDPOINT, headers=headers, params=from_date
+            ) as response:
+                if response.status == HTTPStatus.NOT_MODIFIED:
+                    return None
+                if response.status != HTTPStatus.OK:
+                    raise ApiResponseError(
+                        response.status,
+                        parse_retry_after(response.headers.get('Retry-After'))
+                    )
+                body = await response.read()
+    except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+        raise ConnectionError(f'Ошибка соединения: {error}')
+    logger.info('Данные API успешно получены')
+    if cache is not None and cache.is_unchanged(response.headers, body):
+        return None
+    return json_loads(body)
+
+
+async def async_send_message(bot, chat_id, message, key=None):
+    """Асинхронная отправка сообщения в Telegram."""
+    logger.info('Начата отправка сообщения пользователю')
+    options = {} if key is None else {'key': key}
+    with metrics.telegram_latency.time():
+        await bot.send_message(chat_id=chat_id, text=message, **options)
+    logger.debug('Сообщение пользователю успешно отправлено')
+
+
+async def async_notify(bot, tenant, message):
+    """Отправляем сообщение об ошибке, если оно не было отправлено ранее."""
+    if message == tenant.last_error:
+        logger.info(
+            'Отмена отправки сообщения, данное сообщение '
+            'уже было отправлено: \n"%s"', message
+        )
+        return
+    try:
+        await async_send_message(
+            bot, tenant.chat_id or TELEGRAM_CHAT_ID, message
+        )
+    except asyncio_helper.ApiException:
+        logger.error(
+            'Ошибка при отправке сообщения пользователю. (async)',
+            exc_info=True
+        )
+        return
+    tenant.last_error = message
+
+
+async def async_process_homeworks(bot, tenant, homeworks, store):
+    """Асинхронно отправляем изменившиеся статусы всех домашек."""
+    for homework in reversed(homeworks):
+        tenant.track_review(homework)
+        if not store.is_changed(tenant.name, homework):
+            logger.debug('Статус домашки не изменился.')
+            continue
+        message = get_status_message(homework)
+        logger.info(message)
+        await async_send_message(
+            bot, tenant.chat_id or TELEGRAM_CHAT_ID, message,
+            get_status_key(bot, tenant, homework)
+        )
+        store.update(tenant.name, homework)
+
+
+async def async_request_tenant_answer(session, tenant, breaker):
+    """Асинхронный запрос к API через размыкатель цепи."""
+    try:
+        response = await async_get_api_answer(
+            session, tenant.timestamp, tenant.headers, tenant.cache
+        )
+    except (ConnectionError, ApiResponseError) as error:
+        tenant.record_api_failure(breaker, error)
+        raise
+    tenant.record_api_success(breaker)
+    return response
+
+
+async def async_poll_tenant(session, bot, tenant, store, breaker):
+    """Асинхронно опрашиваем API для одного пользователя."""
+    if not tenant.active or is_api_paused(breaker):
+        return
+    try:
+        response = await async_request_tenant_answer(session, tenant, breaker)
+        if response is None:
+            logger.debug('Ответ API не изменился с прошлого опроса.')
+        else:
+            homeworks = read_homeworks(response)
+            if homeworks:
+                async with tenant.async_lock:
+                    await async_process_homeworks(
+                        bot, tenant, homeworks, store
+                    )
+                tenant.timestamp = response.get(
+                    'current_date', int(time.time())
                 )
-            timestamp = response.get('current_date', int(time.time()))
-        except ApiTelegramException:
-            logger.error(
-                'Ошибка при отправке сообщения пользователю. (main)',
-                exc_info=True
+                store.save_cursor(tenant)
+            else:
+                logger.debug('Список с домашками пуст.')
+            tenant.cache.commit()
+        # The outage is over, so the same error later is news again.
+        tenant.last_error = ''
+    except asyncio_helper.ApiException as error:
+        metrics.poll_errors.inc(type(error).__name__)
+        logger.error(
+            'Ошибка при отправке сообщения пользователю. (async)',
+            exc_info=True
+        )
+    except Exception as error:
+        metrics.poll_errors.inc(type(error).__name__)
+        message = f'Сбой в работе программы: {error}'
+        logger.error(message, exc_info=True)
+        await async_notify(bot, tenant, message)
+
+
+async def sleep_until_reset(reset, delay):
+    """Ждём delay секунд; True, если расписание сбросили раньше."""
+    try:
+        await asyncio.wait_for(reset.wait(), delay)
+    except asyncio.TimeoutError:
+        return False
+    reset.clear()
+    return True
+
+
+async def async_watch(session, bot, tenant, store, breaker, scheduler):
+    """Асинхронный цикл опроса API для одного пользователя."""
+    deadline = tenant.next_poll = scheduler.first_deadline(tenant)
+    reset = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    # Leases and shards are handed over by other threads.
+    tenant.on_reset = lambda tenant: loop.call_soon_threadsafe(reset.set)
+    while True:
+        delay = max(scheduler.fire_time(deadline) - time.monotonic(), 0)
+        if tenant.active:
+            logger.info('Ожидание следующего запроса -- %s секунд.', delay)
+        started = time.monotonic()
+        if await sleep_until_reset(reset, delay):
+            deadline = tenant.next_poll
+        else:
+            metrics.sleep_drift.observe(time.monotonic() - started - delay)
+        await async_poll_tenant(session, bot, tenant, store, breaker)
+        deadline = scheduler.advance(tenant, deadline)
+
+
+async def start_async_webhook(bot, tenants, store):
+    """Запускаем приёмник webhook в цикле asyncio, если он включен."""
+    if not WEBHOOK_PORT:
+        return None
+    check_webhook_settings()
+    tenants = {tenant.name: tenant for tenant in tenants}
+
+    async def handle_event(request):
+        """Обрабатываем событие в формате ответа API."""
+        try:
+            tenant, homeworks = parse_webhook_event(
+                tenants, request.path,
+                request.headers.get('X-Webhook-Secret'), await request.read()
             )
+            async with tenant.async_lock:
+                await async_process_homeworks(bot, tenant, homeworks, store)
+        except WebhookError as error:
+            logger.warning('Событие webhook отклонено: %s', error)
+            return web.Response(status=error.status, text=str(error))
+        except web.HTTPException as error:
+            # The body is over client_max_size.
+            logger.warning('Событие webhook отклонено: %s', error.reason)
+            raise
         except Exception as error:
-            message = f'Сбой в работе программы: {error}'
-            logger.error(message, exc_info=True)
-            if message not in sended_message:
-                try:
-                    send_message(bot, message)
-                    sended_message = message
-                except ApiTelegramException:
-                    logger.error(
-                        'Ошибка при отправке сообщения пользователю. (main)',
-                        exc_info=True
-                    )
+            logger.error('Сбой обработки webhook: %s', error, exc_info=True)
+            return web.Response(
+                status=HTTPStatus.INTERNAL_SERVER_ERROR, text=str(error)
+            )
+        return web.Response(text='ok')
+
+    app = web.Application(client_max_size=WEBHOOK_MAX_BODY)
+    app.router.add_post(WEBHOOK_PATH + '{tenant}', handle_event)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    logger.info('Приём webhook на %s:%s', WEBHOOK_HOST, WEBHOOK_PORT)
+    return runner
+
+
+async def async_main():
+    """Асинхронная логика работы бота."""
+    check_tokens()
+    init_telegram_api(asyncio_helper)
+    bot = AsyncTeleBot(token=TELEGRAM_TOKEN)
+    bot = create_async_sender(bot)
+    connector = aiohttp.TCPConnector(limit=ASYNC_CONNECTION_LIMIT)
+    timeout = aiohttp.ClientTimeout(
+        sock_connect=API_CONNECT_TIMEOUT, sock_read=API_READ_TIMEOUT
+    )
+    async with aiohttp.ClientSession(
+        connector=connector, timeout=timeout
+    ) as session:
+        tenants = get_tenants()
+        store = open_state_store()
+        store.restore(tenants)
+        start_ownership(tenants, store)
+        breaker = CircuitBreaker()
+        webhook = await start_async_webhook(bot, tenants, store)
+        start_metrics_server(tenants, breaker)
+        # The event loop keeps its own timer heap, so tasks only need
+        # the deadline arithmetic of the scheduler.
+        scheduler = create_scheduler(tenants)
+        try:
+            await asyncio.gather(*(
+                async_watch(
+                    session, bot, tenant, store, breaker, scheduler
+                )
+                for tenant in tenants
+            ))
         finally:
-            logger.info(
-                f'Ожидание следующего запроса -- {RETRY_PERIOD} секунд.'
+            if webhook is not None:
+                await webhook.cleanup()
+            await bot.close_session()
+
+
+class HashRing:
+    """Консистентное хеширование пользователей по процессам."""
+
+    def __init__(self, nodes, replicas=RING_REPLICAS):
+        """Раскладываем точки процессов по кольцу."""
+        # Every node owns many points of the ring, so when a node leaves
+        # only its tenants move, and they spread over all other nodes.
+        points = sorted(
+            (stable_hash(f'{node}:{replica}'), node)
+            for node in nodes for replica in range(replicas)
+        )
+        self.hashes = [point for point, _ in points]
+        self.nodes = [node for _, node in points]
+
+    def get_node(self, key):
+        """Процесс, которому принадлежит ключ."""
+        index = bisect.bisect(self.hashes, stable_hash(key))
+        return self.nodes[index % len(self.nodes)]
+
+
+def get_worker_journals():
+    """Журналы состояния всех процессов-воркеров."""
+    # The supervisor gives every worker the STATE_FILE.N journal.
+    base = STATE_FILE.rsplit('.', 1)[0]
+    return [
+        path for path in glob.glob(f'{glob.escape(base)}.*')
+        if path.rsplit('.', 1)[1].isdigit()
+    ]
+
+
+def take_over_state(tenants, store):
+    """Принимаем состояние пользователей из журналов других процессов."""
+    if not tenants or store.journal is None:
+        return
+    # Journals of other workers hold the states and cursors of the tenants
+    # they polled; the newest state wins, the cursor only grows.
+    snapshot = StateStore(max_size=math.inf)
+    for path in get_worker_journals():
+        if path != store.journal.path:
+            StateJournal(path).load(snapshot)
+    by_name = {tenant.name: tenant for tenant in tenants}
+    for (tenant_name, homework_id), state in snapshot.items():
+        tenant = by_name.get(tenant_name)
+        current = store.get(tenant_name, homework_id)
+        if tenant is None or current is not None and current >= state:
+            continue
+        store.set(tenant_name, homework_id, state)
+        store.journal.write(('h', tenant_name, homework_id, state), False)
+        if state & STATUS_MASK == REVIEWING:
+            tenant.reviewing.add(homework_id)
+        else:
+            tenant.reviewing.discard(homework_id)
+    for tenant in tenants:
+        tenant.timestamp = max(
+            tenant.timestamp, snapshot.cursors.get(tenant.name, 0)
+        )
+        store.save_cursor(tenant)
+
+
+def assign_shard(tenants, workers, store):
+    """Оставляем процессу только пользователей его сегмента."""
+    ring = HashRing(workers)
+    worker = int(WORKER_ID)
+    gained = []
+    for tenant in tenants:
+        owned = ring.get_node(tenant.name) == worker
+        if owned and not tenant.owned:
+            gained.append(tenant)
+        else:
+            tenant.owned = owned
+    # A tenant is polled only after its state is taken over, so neither
+    # the previous owner's notifications nor its cursor are lost.
+    take_over_state(gained, store)
+    for tenant in gained:
+        tenant.owned = True
+        tenant.reset_schedule()
+    logger.info(
+        'Процесс %s опрашивает пользователей: %s из %s, процессы: %s',
+        worker, sum(tenant.owned for tenant in tenants), len(tenants),
+        workers
+    )
+
+
+def follow_supervisor(tenants, store):
+    """Получаем состав процессов от супервизора, пока он работает."""
+    for line in sys.stdin:
+        assign_shard(tenants, json.loads(line)['workers'], store)
+    logger.critical('Супервизор завершился, останавливаем процесс.')
+    os.kill(os.getpid(), signal.SIGTERM)
+
+
+class SqliteLeases:
+    """Аренды пользователей в общей базе SQLite."""
+
+    # A lease is taken over only when it expired; the cursor only grows,
+    # so a new owner continues from where the previous one stopped.
+    UPSERT = (
+        'INSERT INTO leases (tenant, node, expires, cursor) '
+        'VALUES (?, ?, ?, ?) ON CONFLICT (tenant) DO UPDATE SET '
+        'node = excluded.node, expires = excluded.expires, '
+        'cursor = MAX(IFNULL(leases.cursor, 0), excluded.cursor) '
+        'WHERE leases.node = excluded.node OR leases.expires < ?'
+    )
+    RELEASE = (
+        'UPDATE leases SET expires = 0, '
+        'cursor = MAX(IFNULL(cursor, 0), ?) WHERE tenant = ? AND node = ?'
+    )
+
+    def __init__(self, path):
+        """Открываем базу аренд и создаём таблицу."""
+        self.connection = sqlite3.connect(
+            path, timeout=LEASE_TTL / 3, isolation_level=None,
+            check_same_thread=False
+        )
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS leases (tenant TEXT PRIMARY KEY, '
+            'node TEXT NOT NULL, expires REAL NOT NULL, cursor INTEGER)'
+        )
+
+    @contextmanager
+    def transaction(self):
+        """Транзакция с блокировкой записи с самого начала."""
+        # Two nodes never see the same expired lease as free.
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            self.connection.execute('ROLLBACK')
+            raise
+        self.connection.execute('COMMIT')
+
+    def acquire(self, node, cursors, ttl):
+        """Продлеваем аренды узла и берём свободные, возвращаем курсоры."""
+        now = time.time()
+        with self.transaction():
+            self.connection.executemany(self.UPSERT, (
+                (name, node, now + ttl, cursor, now)
+                for name, cursor in cursors.items()
+            ))
+            return dict(self.connection.execute(
+                'SELECT tenant, cursor FROM leases '
+                'WHERE node = ? AND expires > ?', (node, now)
+            ))
+
+    def release(self, node, cursors):
+        """Отдаём аренды, сохраняя курсоры для следующего владельца."""
+        with self.transaction():
+            self.connection.executemany(self.RELEASE, (
+                (cursor, name, node) for name, cursor in cursors.items()
+            ))
+
+
+LEASE_BACKENDS = {'sqlite': SqliteLeases}
+
+
+class LeaseKeeper:
+    """Держит аренды пользователей этим узлом."""
+
+    def __init__(self, backend, tenants, node=NODE_ID, ttl=LEASE_TTL):
+        """Пока аренды не взяты, пользователей не опрашиваем."""
+        self.backend = backend
+        self.tenants = tenants
+        self.node = node
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        for tenant in tenants:
+            tenant.leased = False
+
+    def renew(self):
+        """Продлеваем свои аренды и забираем истёкшие чужие."""
+        # Only tenants of this worker's shard are candidates.
+        cursors = {
+            tenant.name: tenant.timestamp
+            for tenant in self.tenants if tenant.owned
+        }
+        try:
+            leases = self.backend.acquire(self.node, cursors, self.ttl)
+        except Exception as error:
+            # An unconfirmed lease may already belong to another node.
+            logger.error('Не удалось продлить аренды: %s', error)
+            leases = {}
+        for tenant in self.tenants:
+            leased = tenant.name in cursors and tenant.name in leases
+            if leased and not tenant.leased:
+                tenant.timestamp = max(
+                    tenant.timestamp, leases[tenant.name] or 0
+                )
+                tenant.reset_schedule()
+                logger.info('Узел %s взял пользователя %s',
+                            self.node, tenant.name)
+            elif tenant.leased and not leased:
+                logger.warning('Узел %s потерял пользователя %s',
+                               self.node, tenant.name)
+            tenant.leased = leased
+        # Leases left from the shard this worker no longer owns.
+        self.release({
+            tenant.name: tenant.timestamp
+            for tenant in self.tenants
+            if tenant.name in leases and tenant.name not in cursors
+        })
+
+    def release(self, cursors):
+        """Отдаём аренды другим узлам."""
+        if not cursors:
+            return
+        try:
+            self.backend.release(self.node, cursors)
+        except Exception as error:
+            logger.error('Не удалось освободить аренды: %s', error)
+
+    def run(self):
+        """Продлеваем аренды втрое чаще, чем они истекают."""
+        while not self.stopped.wait(self.ttl / 3):
+            with self.lock:
+                self.renew()
+
+    def stop(self):
+        """Освобождаем аренды при остановке, чтобы не ждать их истечения."""
+        with self.lock:
+            self.stopped.set()
+            self.release({
+                tenant.name: tenant.timestamp
+                for tenant in self.tenants if tenant.leased
+            })
+            for tenant in self.tenants:
+                tenant.leased = False
+
+    def start(self):
+        """Берём аренды и продлеваем их в фоновом потоке."""
+        with self.lock:
+            self.renew()
+        threading.Thread(target=self.run, daemon=True).start()
+        register_shutdown(self.stop)
+
+
+def create_lease_backend():
+    """Создаём хранилище аренд по настройке LEASE_BACKEND."""
+    if LEASE_BACKEND not in LEASE_BACKENDS:
+        raise ValueError(f'Неизвестное хранилище аренд: {LEASE_BACKEND}')
+    return LEASE_BACKENDS[LEASE_BACKEND](LEASE_FILE)
+
+
+def start_ownership(tenants, store):
+    """Делим пользователей с другими процессами и узлами."""
+    if WORKER_ID is not None:
+        # A restarted worker takes its tenants over like any other worker:
+        # they were polled by others while it was down.
+        for tenant in tenants:
+            tenant.owned = False
+        # The supervisor sends the first membership right after the start.
+        assign_shard(
+            tenants, json.loads(sys.stdin.readline())['workers'], store
+        )
+        threading.Thread(
+            target=follow_supervisor, args=(tenants, store), daemon=True
+        ).start()
+    if LEASE_FILE:
+        LeaseKeeper(create_lease_backend(), tenants).start()
+
+
+def get_worker_metrics_port(worker):
+    """Порт метрик процесса-воркера."""
+    return METRICS_PORT + 1 + worker if METRICS_PORT else 0
+
+
+def merge_metrics(pages):
+    """Объединяем метрики процессов, добавляя к ним метку worker."""
+    families = {}
+    for worker, page in pages:
+        samples = None
+        for line in page.splitlines():
+            if line.startswith('#'):
+                header, samples = families.setdefault(
+                    line.split()[2], ([], [])
+                )
+                # HELP and TYPE are written once per metric family.
+                if line not in header:
+                    header.append(line)
+            elif line and samples is not None:
+                name, value = line.rsplit(' ', 1)
+                label = f'worker="{worker}"'
+                if name.endswith('}'):
+                    name = f'{name[:-1]},{label}}}'
+                else:
+                    name = f'{name}{{{label}}}'
+                samples.append(f'{name} {value}')
+    lines = itertools.chain.from_iterable(
+        header + samples for header, samples in families.values()
+    )
+    return '\n'.join(lines) + '\n'
+
+
+class WorkerMetricsHandler(MetricsHandler):
+    """Отдаём метрики всех процессов-воркеров."""
+
+    def render(self):
+        """Собираем метрики живых процессов."""
+        pages = []
+        for worker in self.server.supervisor.get_workers():
+            url = f'http://127.0.0.1:{get_worker_metrics_port(worker)}/metrics'
+            try:
+                pages.append((worker, requests.get(url, timeout=1).text))
+            except requests.RequestException as error:
+                logger.warning(
+                    'Метрики процесса %s недоступны: %s', worker, error
+                )
+        return merge_metrics(pages)
+
+
+class Supervisor:
+    """Запускаем процессы опроса и делим между ними пользователей."""
+
+    def __init__(self, size, engine):
+        """Готовим запуск size процессов с движком engine."""
+        self.size = size
+        self.engine = engine
+        self.processes = {}
+        # Dead workers and the moment to start them again.
+        self.restarts = {}
+        self.lock = threading.Lock()
+
+    def get_workers(self):
+        """Номера живых процессов."""
+        with self.lock:
+            return sorted(self.processes)
+
+    def spawn(self, worker):
+        """Запускаем процесс-воркер."""
+        env = dict(
+            os.environ,
+            WORKERS='0',
+            WORKER_ID=str(worker),
+            METRICS_PORT=str(get_worker_metrics_port(worker)),
+            # A port can't be shared and events would reach a random
+            # worker, so webhooks are not received in this mode.
+            WEBHOOK_PORT='0',
+            # Telegram limits the bot as a whole.
+            SEND_GLOBAL_RATE=str(SEND_GLOBAL_RATE / self.size),
+        )
+        for name in ('STATE_FILE', 'OUTBOX_FILE'):
+            if os.getenv(name):
+                env[name] = f'{os.environ[name]}.{worker}'
+        process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__),
+             '--engine', self.engine],
+            env=env, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT, text=True, bufsize=1
+        )
+        threading.Thread(
+            target=self.forward_logs, args=(worker, process), daemon=True
+        ).start()
+        with self.lock:
+            self.processes[worker] = process
+        logger.info('Запущен процесс %s, pid %s', worker, process.pid)
+
+    def forward_logs(self, worker, process):
+        """Пересылаем вывод процесса в общий лог с его номером."""
+        for line in process.stdout:
+            sys.stdout.write(f'[worker {worker}] {line}')
+            sys.stdout.flush()
+
+    def broadcast(self):
+        """Сообщаем живым процессам их состав."""
+        workers = self.get_workers()
+        message = json.dumps({'workers': workers}) + '\n'
+        for worker in workers:
+            try:
+                self.processes[worker].stdin.write(message)
+                self.processes[worker].stdin.flush()
+            except OSError:
+                # The worker has just died and is reaped on the next check.
+                pass
+
+    def reap(self):
+        """Убираем завершившиеся процессы, True если такие были."""
+        dead = [
+            worker for worker, process in self.processes.items()
+            if process.poll() is not None
+        ]
+        for worker in dead:
+            logger.error(
+                'Процесс %s завершился с кодом %s, его пользователи '
+                'переданы остальным', worker, self.processes[worker].returncode
             )
-            time.sleep(RETRY_PERIOD)
+            with self.lock:
+                del self.processes[worker]
+            self.restarts[worker] = time.monotonic() + WORKER_RESTART_DELAY
+        return bool(dead)
+
+    def respawn(self):
+        """Перезапускаем упавшие процессы, True если такие были."""
+        due = [
+            worker for worker, restart_at in self.restarts.items()
+            if restart_at <= time.monotonic()
+        ]
+        for worker in due:
+            del self.restarts[worker]
+            self.spawn(worker)
+        return bool(due)
+
+    def stop(self):
+        """Останавливаем все процессы."""
+        for process in self.processes.values():
+            process.terminate()
+        for process in self.processes.values():
+            process.wait()
+
+    def run(self):
+        """Запускаем процессы и следим за ними."""
+        register_shutdown(self.stop)
+        for worker in range(self.size):
+            self.spawn(worker)
+        self.broadcast()
+        if METRICS_PORT:
+            serve_metrics(WorkerMetricsHandler, supervisor=self)
+        while True:
+            time.sleep(WORKER_CHECK_INTERVAL)
+            # Survivors take over the tenants first, then the dead worker
+            # is started again and gets its segment back.
+            if self.reap():
+                self.broadcast()
+            if self.respawn():
+                self.broadcast()
+
+
+def drain_sender(sender):
+    """Ждём отправки сообщений из очереди перед выходом."""
+    # Messages an outbox failed to deliver stay in its journal.
+    while isinstance(sender, (Outbox, Digest)):
+        if isinstance(sender, Digest):
+            sender.flush_all()
+        sender = sender.sender
+    if isinstance(sender, MessageQueue):
+        sender.join()
+
+
+def run_once():
+    """Один круг опроса всех пользователей, возвращает код выхода."""
+    if not STATE_FILE:
+        sys.exit('Для запуска с --once задайте STATE_FILE.')
+    check_tokens()
+    init_api_client()
+    if api_client is None:
+        set_api_client(ApiClient(pool_size=ONCE_WORKERS))
+    init_telegram_api(apihelper)
+    # Telegram is imported and the bot is built only if there is news.
+    bot = create_sender(
+        Lazy('TeleBot()', lambda: TeleBot(token=TELEGRAM_TOKEN))
+    )
+    tenants = get_tenants()
+    store = open_state_store()
+    store.restore(tenants)
+    start_ownership(tenants, store)
+    breaker = CircuitBreaker()
+    with ThreadPoolExecutor(max_workers=ONCE_WORKERS) as pool:
+        results = list(pool.map(
+            lambda tenant: poll_tenant(bot, tenant, store, breaker), tenants
+        ))
+    drain_sender(bot)
+    polled = [result for result in results if result is not None]
+    failed = polled.count(False)
+    logger.info('Опрошено пользователей: %s, со сбоями: %s',
+                len(polled), failed)
+    if not failed:
+        return 0
+    return EXIT_FAILED if failed == len(polled) else EXIT_PARTIAL
+
+
+def parse_args(argv=None):
+    """Разбираем аргументы командной строки."""
+    parser = argparse.ArgumentParser(
+        description='Бот проверки статуса домашней работы.'
+    )
+    parser.add_argument(
+        '--engine', choices=ENGINES, default=ENGINE,
+        help='Движок опроса API: блокирующий или asyncio.'
+    )
+    parser.add_argument(
+        '--workers', type=int, default=WORKERS,
+        help='Число процессов опроса, между которыми делятся пользователи.'
+    )
+    parser.add_argument(
+        '--backfill', nargs='*', metavar='TENANT',
+        help='Заполнить состояние всей историей домашек без уведомлений '
+             'и выйти; без имён -- для всех пользователей.'
+    )
+    parser.add_argument(
+        '--once', action='store_true',
+        help='Опросить всех пользователей один раз и выйти.'
+    )
+    return parser.parse_args(argv)
+
+
+def run(argv=None):
+    """Запускаем выбранный движок опроса."""
+    args = parse_args(argv)
+    if args.backfill is not None:
+        backfill(args.backfill)
+    elif args.once:
+        sys.exit(run_once())
+    elif args.workers:
+        Supervisor(args.workers, args.engine).run()
+    elif args.engine == 'async':
+        asyncio.run(async_main())
+    else:
+        main()
+
 
+startup_times.append(('homework', time.perf_counter() - module_started))
+if STARTUP_REPORT:
+    atexit.register(report_startup)
 
 if __name__ == '__main__':
-    main()
+    run()
@@ -0,0 +1,34 @@
+import threading
+
+
+class TestCircuitBreaker:
+
+    def test_single_probe_across_threads(self, homework_module):
+        breaker = homework_module.CircuitBreaker(threshold=1, reset_timeout=0)
+        breaker.record_failure(ConnectionError('нет сети'))
+        barrier = threading.Barrier(8)
+        allowed = []
+
+        def request():
+            barrier.wait()
+            allowed.append(breaker.allow_request())
+
+        threads = [threading.Thread(target=request) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert allowed.count(True) == 1, (
+            'В полуоткрытом состоянии пробный запрос разрешается '
+            'только одному потоку.'
+        )
+
+    def test_opens_after_threshold(self, homework_module):
+        breaker = homework_module.CircuitBreaker(threshold=2)
+        breaker.record_failure(ConnectionError('нет сети'))
+        assert breaker.allow_request()
+        breaker.record_failure(ConnectionError('нет сети'))
+        assert not breaker.allow_request()
+        assert breaker.get_status()['state'] == breaker.OPEN
+        breaker.record_success()
+        assert breaker.allow_request()
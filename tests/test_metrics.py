@@ -0,0 +1,35 @@
+import threading
+
+
+class TestMetrics:
+
+    def test_counter_survives_concurrent_updates(self, homework_module):
+        counter = homework_module.Counter('test_total', 'Тест.')
+        histogram = homework_module.Histogram('test_seconds', 'Тест.')
+
+        def update():
+            for _ in range(2000):
+                counter.inc()
+                histogram.observe(0.1)
+
+        threads = [threading.Thread(target=update) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert counter.values[None] == 8000
+        assert histogram.count == sum(histogram.counts) == 8000
+
+    def test_client_error_is_not_success(self, homework_module):
+        tenant = homework_module.Tenant('student')
+        breaker = homework_module.CircuitBreaker()
+        tenant.failures = 2
+        tenant.record_api_failure(
+            breaker, homework_module.ApiResponseError(401)
+        )
+        assert tenant.failures == 0
+        assert tenant.last_success is None, (
+            'Ответ 4xx не должен считаться успешным опросом.'
+        )
+        tenant.record_api_success(breaker)
+        assert tenant.last_success is not None
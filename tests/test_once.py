@@ -0,0 +1,45 @@
+import pytest
+
+
+class TestRunOnce:
+
+    @pytest.fixture
+    def run(self, homework_module, monkeypatch, tmp_path):
+        """Запускаем один круг с заданными итогами опроса пользователей."""
+        monkeypatch.setattr(
+            homework_module, 'STATE_FILE', str(tmp_path / 'state')
+        )
+        monkeypatch.setattr(homework_module, 'api_client', object())
+        monkeypatch.setattr(homework_module, 'WORKER_ID', None)
+        monkeypatch.setattr(homework_module, 'LEASE_FILE', None)
+        monkeypatch.setattr(homework_module, 'SEND_QUEUE', False)
+        monkeypatch.setattr(homework_module, 'OUTBOX_FILE', None)
+        monkeypatch.setattr(homework_module, 'DIGEST_WINDOW', 0)
+        monkeypatch.setattr(
+            homework_module, 'open_state_store', homework_module.StateStore
+        )
+
+        def run(*results):
+            results = dict(zip(('first', 'second', 'third'), results))
+            monkeypatch.setattr(
+                homework_module, 'get_tenants',
+                lambda: [homework_module.Tenant(name) for name in results]
+            )
+            monkeypatch.setattr(
+                homework_module, 'poll_tenant',
+                lambda bot, tenant, store, breaker: results[tenant.name]
+            )
+            return homework_module.run_once()
+
+        return run
+
+    def test_all_polled(self, run):
+        assert run(True, True, None) == 0, (
+            'Пользователи другого процесса не считаются сбоем.'
+        )
+
+    def test_some_failed(self, homework_module, run):
+        assert run(True, False, None) == homework_module.EXIT_PARTIAL == 2
+
+    def test_all_failed(self, homework_module, run):
+        assert run(False, False, None) == homework_module.EXIT_FAILED == 3
@@ -0,0 +1,346 @@
+import asyncio
+import email.utils
+import json
+import time
+from http.client import RemoteDisconnected
+
+import pytest
+import requests
+from urllib3.exceptions import ProtocolError
+
+
+class RecordingBot:
+    """Бот, который запоминает отправленные сообщения."""
+
+    def __init__(self):
+        self.sent = []
+
+    def send_message(self, chat_id, text, **options):
+        self.sent.append(text)
+
+
+class AsyncRecordingBot(RecordingBot):
+
+    async def send_message(self, chat_id, text, **options):
+        super().send_message(chat_id, text, **options)
+
+
+def get_answers(*answers):
+    """Ответы API по очереди: исключение или None (без изменений)."""
+    answers = iter(answers)
+
+    def request(*args):
+        answer = next(answers)
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+    return request
+
+
+class TestErrorNotices:
+
+    def get_outage(self, homework_module):
+        return (
+            homework_module.ApiResponseError(500),
+            None,
+            homework_module.ApiResponseError(500),
+        )
+
+    def test_same_error_after_recovery_is_sent(
+        self, homework_module, monkeypatch
+    ):
+        monkeypatch.setattr(
+            homework_module, 'request_tenant_answer',
+            get_answers(*self.get_outage(homework_module))
+        )
+        bot = RecordingBot()
+        tenant = homework_module.Tenant('student')
+        breaker = homework_module.CircuitBreaker()
+        store = homework_module.StateStore()
+        results = [
+            homework_module.poll_tenant(bot, tenant, store, breaker)
+            for _ in range(3)
+        ]
+        assert results == [False, True, False]
+        assert len(bot.sent) == 2, (
+            'После успешного опроса та же ошибка -- новый сбой, '
+            'о нём нужно сообщить снова.'
+        )
+
+    def test_same_error_after_recovery_is_sent_async(
+        self, homework_module, monkeypatch
+    ):
+        request = get_answers(*self.get_outage(homework_module))
+
+        async def async_request(*args):
+            return request()
+
+        monkeypatch.setattr(
+            homework_module, 'async_request_tenant_answer', async_request
+        )
+        bot = AsyncRecordingBot()
+        tenant = homework_module.Tenant('student')
+        breaker = homework_module.CircuitBreaker()
+        store = homework_module.StateStore()
+
+        async def run():
+            for _ in range(3):
+                await homework_module.async_poll_tenant(
+                    None, bot, tenant, store, breaker
+                )
+
+        asyncio.run(run())
+        assert len(bot.sent) == 2
+
+    def test_repeated_error_is_sent_once(self, homework_module, monkeypatch):
+        error = homework_module.ApiResponseError(500)
+        monkeypatch.setattr(
+            homework_module, 'request_tenant_answer',
+            get_answers(error, error)
+        )
+        bot = RecordingBot()
+        tenant = homework_module.Tenant('student')
+        breaker = homework_module.CircuitBreaker()
+        for _ in range(2):
+            homework_module.poll_tenant(
+                bot, tenant, homework_module.StateStore(), breaker
+            )
+        assert len(bot.sent) == 1
+
+
+class FailingSession:
+    """Сессия, первые запросы которой падают с заданными ошибками."""
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def get(self, url, **kwargs):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return 'response'
+
+
+class TestApiClient:
+
+    def get_client(self, homework_module, session):
+        client = homework_module.ApiClient(pool_size=1)
+        client.session = session
+        return client
+
+    def test_stale_socket_is_retried_once(self, homework_module):
+        stale = requests.ConnectionError(ProtocolError(
+            'Connection aborted.', RemoteDisconnected('closed')
+        ))
+        session = FailingSession(stale)
+        client = self.get_client(homework_module, session)
+        assert client.get('http://api') == 'response'
+        assert client.session is session, (
+            'Общая сессия не должна пересоздаваться: ею пользуются '
+            'другие потоки.'
+        )
+        assert session.calls == 2
+
+    @pytest.mark.parametrize('error', [
+        requests.ConnectTimeout('timeout'),
+        requests.ConnectionError('Connection refused'),
+    ])
+    def test_outage_is_not_retried(self, homework_module, error):
+        session = FailingSession(error)
+        client = self.get_client(homework_module, session)
+        with pytest.raises(requests.ConnectionError):
+            client.get('http://api')
+        assert session.calls == 1, (
+            'Повторы при недоступном API делают отсрочка и размыкатель, '
+            'а не HTTP-клиент.'
+        )
+
+    def test_adapter_does_not_retry(self, homework_module):
+        client = homework_module.ApiClient(pool_size=1)
+        adapter = client.session.get_adapter('https://api')
+        assert adapter.max_retries.total == 0
+
+
+class TestReadHomework:
+
+    def test_name_of_any_type(self, homework_module):
+        homework = homework_module.read_homework(
+            {'id': 1, 'homework_name': 123, 'status': 'approved'}
+        )
+        assert homework.name == 123, (
+            'Название домашки не обязано быть строкой, как и раньше '
+            'в `parse_status`.'
+        )
+        assert '123' in homework_module.get_status_message(homework)
+
+    def test_string_names_are_shared(self, homework_module):
+        first, second = (
+            homework_module.read_homework({
+                'id': 1, 'homework_name': ''.join(['hw', '_1']),
+                'status': 'approved'
+            })
+            for _ in range(2)
+        )
+        assert first.name is second.name
+
+
+class TestProcessHomeworks:
+
+    def get_homeworks(self, homework_module, statuses):
+        # API lists the most recently updated homework first.
+        return homework_module.read_homeworks({'homeworks': [
+            {'id': number, 'homework_name': f'hw_{number}', 'status': status,
+             'date_updated': f'2024-01-0{number}T00:00:00Z'}
+            for number, status in reversed(list(enumerate(statuses, 1)))
+        ]})
+
+    def test_every_homework_oldest_first(self, homework_module):
+        bot = RecordingBot()
+        tenant = homework_module.Tenant('student')
+        homework_module.process_homeworks(
+            bot, tenant, self.get_homeworks(
+                homework_module, ['approved', 'reviewing', 'rejected']
+            ), homework_module.StateStore()
+        )
+        assert [
+            next(name for name in ('hw_1', 'hw_2', 'hw_3') if name in text)
+            for text in bot.sent
+        ] == ['hw_1', 'hw_2', 'hw_3'], (
+            'Нужно сообщать о каждой домашке из ответа, начиная со старой.'
+        )
+
+    def test_each_status_is_sent_once(self, homework_module):
+        bot = RecordingBot()
+        tenant = homework_module.Tenant('student')
+        store = homework_module.StateStore()
+        for statuses in (
+            ['reviewing', 'reviewing'],
+            ['reviewing', 'reviewing'],
+            ['reviewing', 'approved'],
+        ):
+            homework_module.process_homeworks(
+                bot, tenant, self.get_homeworks(homework_module, statuses),
+                store
+            )
+        assert len(bot.sent) == 3, (
+            'Статус каждой домашки отправляется один раз, повторно -- '
+            'только после его изменения.'
+        )
+        assert 'hw_2' in bot.sent[-1]
+
+
+class TestRetryAfter:
+
+    def test_seconds(self, homework_module):
+        assert homework_module.parse_retry_after('120') == 120
+        assert homework_module.parse_retry_after('-5') == 0
+
+    def test_http_date(self, homework_module):
+        value = email.utils.formatdate(time.time() + 60, usegmt=True)
+        assert homework_module.parse_retry_after(value) == pytest.approx(
+            60, abs=2
+        ), 'Retry-After может быть датой HTTP, а не числом секунд.'
+
+    @pytest.mark.parametrize('value', [None, '', 'soon'])
+    def test_missing_or_invalid(self, homework_module, value):
+        assert homework_module.parse_retry_after(value) is None
+
+    def test_backoff_honours_retry_after(self, homework_module):
+        delays = [
+            homework_module.get_backoff_delay(1, retry_after=500)
+            for _ in range(20)
+        ]
+        assert min(delays) >= 500, (
+            'Отсрочка не должна быть короче Retry-After сервера.'
+        )
+
+    def test_backoff_is_capped(self, homework_module):
+        delays = [
+            homework_module.get_backoff_delay(failures)
+            for failures in range(1, 100)
+        ]
+        assert all(
+            0 <= delay <= homework_module.BACKOFF_MAX for delay in delays
+        )
+
+    def test_rate_limited_answer_is_retried_after(
+        self, homework_module, monkeypatch
+    ):
+        monkeypatch.setattr(
+            homework_module, 'get_backoff_delay',
+            lambda failures, retry_after=None: retry_after or 0
+        )
+        error = homework_module.ApiResponseError(429, retry_after=90)
+        tenant = homework_module.Tenant('student')
+        tenant.record_api_failure(homework_module.CircuitBreaker(), error)
+        assert tenant.schedule_next_poll() == 90
+
+
+class FakeResponse:
+    """Ответ API с заголовками и телом."""
+
+    def __init__(self, status_code, body=None, headers=None):
+        self.status_code = status_code
+        self.content = body
+        self.headers = headers or {}
+
+
+class TestConditionalPolling:
+
+    def get_body(self, status, current_date):
+        return json.dumps({'current_date': current_date, 'homeworks': [
+            {'id': 1, 'homework_name': 'hw_1', 'status': status},
+        ]}).encode()
+
+    @pytest.fixture
+    def poll(self, homework_module, monkeypatch):
+        """Опрашиваем API заданными ответами, считая разборы тела."""
+        self.requests = []
+        self.decoded = []
+        json_loads = homework_module.json_loads
+
+        def decode(body):
+            self.decoded.append(body)
+            return json_loads(body)
+
+        monkeypatch.setattr(homework_module, 'json_loads', decode)
+        bot = RecordingBot()
+        tenant = homework_module.Tenant('student')
+        store = homework_module.StateStore()
+        breaker = homework_module.CircuitBreaker()
+
+        def poll(response):
+            def fetch(timestamp, headers):
+                self.requests.append(headers)
+                return response
+
+            monkeypatch.setattr(homework_module, 'fetch_api_response', fetch)
+            return homework_module.poll_tenant(bot, tenant, store, breaker)
+
+        return poll
+
+    def test_unchanged_answer_is_not_decoded(self, poll):
+        assert poll(FakeResponse(
+            200, self.get_body('reviewing', 100), {'ETag': '"v1"'}
+        ))
+        assert len(self.decoded) == 1
+        assert self.requests[0].get('If-None-Match') is None
+        assert poll(FakeResponse(304))
+        assert self.requests[1]['If-None-Match'] == '"v1"'
+        assert poll(FakeResponse(200, self.get_body('reviewing', 200)))
+        assert len(self.decoded) == 1, (
+            'Ответ 304 и тело, отличающееся только current_date, '
+            'не нужно разбирать заново.'
+        )
+
+    def test_failed_answer_is_not_committed(self, poll):
+        body = self.get_body('unknown', 100)
+        for _ in range(2):
+            assert poll(FakeResponse(200, body, {'ETag': '"v1"'})) is False
+        assert len(self.decoded) == 2, (
+            'Валидаторы ответа запоминаются только после его успешной '
+            'обработки, иначе сбойный ответ больше не разберут.'
+        )
+        assert all('If-None-Match' not in headers for headers in self.requests)
@@ -0,0 +1,77 @@
+import time
+
+import pytest
+
+
+class TestDeadlineScheduler:
+    INTERVAL = 60
+
+    @pytest.fixture
+    def tenant(self, homework_module, monkeypatch):
+        monkeypatch.setattr(homework_module, 'ADAPTIVE_POLLING', False)
+        tenant = homework_module.Tenant('student')
+        tenant.interval = self.INTERVAL
+        return tenant
+
+    @pytest.fixture
+    def scheduler(self, homework_module, tenant, monkeypatch):
+        monkeypatch.setattr(homework_module, 'POLL_STAGGER', False)
+        return homework_module.DeadlineScheduler([tenant])
+
+    def test_next_deadline_counts_from_previous(self, scheduler, tenant):
+        deadline = time.monotonic() - 5
+        assert scheduler.advance(tenant, deadline) == deadline + 60, (
+            'Следующий срок отсчитывается от прошлого срока, поэтому '
+            'время опроса не накапливается в дрейф.'
+        )
+        assert tenant.next_poll == deadline + 60
+
+    def test_missed_deadlines_are_skipped(
+        self, homework_module, scheduler, tenant
+    ):
+        overruns = homework_module.metrics.poll_overruns.values.get(None, 0)
+        deadline = time.monotonic() - 250
+        next_deadline = scheduler.advance(tenant, deadline)
+        assert next_deadline == deadline + 5 * 60, (
+            'Пропущенные сроки не навёрстываются подряд: опрос встаёт '
+            'на ближайший будущий срок той же сетки.'
+        )
+        assert homework_module.metrics.poll_overruns.values[None] == (
+            overruns + 1
+        )
+
+    def test_failure_backs_off_from_now(
+        self, homework_module, scheduler, tenant, monkeypatch
+    ):
+        monkeypatch.setattr(
+            homework_module, 'get_backoff_delay', lambda *args: 7
+        )
+        tenant.failures = 1
+        deadline = time.monotonic() - 1000
+        next_deadline = scheduler.advance(tenant, deadline)
+        assert next_deadline == pytest.approx(time.monotonic() + 7, abs=1)
+
+    def test_due_tenants_pop_in_deadline_order(
+        self, homework_module, monkeypatch
+    ):
+        monkeypatch.setattr(homework_module, 'POLL_STAGGER', False)
+        monkeypatch.setattr(homework_module, 'POLL_JITTER', 0)
+        first, second = (
+            homework_module.Tenant(name) for name in ('first', 'second')
+        )
+        scheduler = homework_module.DeadlineScheduler([first, second])
+        polled = []
+        monkeypatch.setattr(
+            homework_module, 'poll_tenant',
+            lambda bot, tenant, store, breaker: polled.append(tenant.name)
+        )
+        scheduler.deadlines = []
+        now = time.monotonic()
+        for position, (tenant, deadline) in enumerate(
+            [(first, now - 1), (second, now - 2)]
+        ):
+            tenant.next_poll = deadline
+            scheduler.push(position, deadline, tenant)
+        delay = scheduler.poll_due(None, None, None)
+        assert polled == ['second', 'first']
+        assert delay > 0
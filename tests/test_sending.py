@@ -0,0 +1,358 @@
+import asyncio
+import threading
+import time
+
+import pytest
+import requests
+
+
+class FlakyBot:
+    """Бот, у которого первая отправка падает с ошибкой соединения."""
+
+    def __init__(self, failures=1):
+        self.failures = failures
+        self.sent = []
+
+    def send_message(self, chat_id, text):
+        if self.failures:
+            self.failures -= 1
+            raise requests.ConnectionError('Telegram недоступен')
+        self.sent.append((chat_id, text))
+
+
+class AsyncFlakyBot(FlakyBot):
+
+    async def send_message(self, chat_id, text):
+        super().send_message(chat_id, text)
+
+
+def get_fast_limiter(homework_module):
+    return homework_module.RateLimiter(global_rate=1000, chat_rate=1000)
+
+
+class TestMessageQueue:
+
+    def test_worker_survives_connection_error(self, homework_module):
+        bot = FlakyBot()
+        sender = homework_module.MessageQueue(
+            bot, workers=1, limiter=get_fast_limiter(homework_module)
+        )
+        failed = []
+        sender.on_failed = failed.append
+        threads = threading.active_count()
+        sender.put(1, 'first', 'k1')
+        sender.put(1, 'second', 'k2')
+        sender.join()
+        assert failed == ['k1'], (
+            'Сообщение, которое не удалось отправить из-за ошибки '
+            'соединения, должно передаваться в `on_failed`.'
+        )
+        assert bot.sent == [(1, 'second')], (
+            'После ошибки соединения отправитель очереди должен '
+            'продолжать отправку следующих сообщений.'
+        )
+        assert threading.active_count() == threads
+
+    def test_async_worker_survives_connection_error(self, homework_module):
+        bot = AsyncFlakyBot()
+
+        async def run():
+            sender = homework_module.AsyncMessageQueue(
+                bot, workers=1, limiter=get_fast_limiter(homework_module)
+            )
+            failed = []
+            sender.on_failed = failed.append
+            sender.put(1, 'first', 'k1')
+            sender.put(1, 'second', 'k2')
+            await sender.queues[0].join()
+            alive = not sender.tasks[0].done()
+            for task in sender.tasks:
+                task.cancel()
+            return failed, alive
+
+        failed, alive = asyncio.run(run())
+        assert failed == ['k1']
+        assert bot.sent == [(1, 'second')]
+        assert alive, 'Задача отправителя не должна завершаться при сбое.'
+
+    def test_plain_queue_is_joined_on_shutdown(
+        self, homework_module, monkeypatch
+    ):
+        monkeypatch.setattr(homework_module, 'SEND_QUEUE', True)
+        monkeypatch.setattr(homework_module, 'OUTBOX_FILE', None)
+        monkeypatch.setattr(homework_module, 'DIGEST_WINDOW', 0)
+        callbacks = []
+        monkeypatch.setattr(
+            homework_module, 'register_shutdown', callbacks.append
+        )
+        sender = homework_module.create_sender(FlakyBot(failures=0))
+        assert callbacks == [sender.join], (
+            'Без outbox очередь отправки нужно дождаться при выходе, '
+            'иначе сообщения пропадут вместе с потоками-демонами.'
+        )
+
+    def test_async_queue_is_drained_on_close(self, homework_module):
+        bot = AsyncFlakyBot(failures=0)
+        bot.closed = False
+
+        async def close_session():
+            bot.closed = True
+
+        bot.close_session = close_session
+
+        async def run():
+            sender = homework_module.AsyncMessageQueue(
+                bot, workers=2, limiter=get_fast_limiter(homework_module)
+            )
+            for number in range(3):
+                sender.put(number, f'text {number}')
+            await sender.close_session()
+
+        asyncio.run(run())
+        assert sorted(bot.sent) == [(n, f'text {n}') for n in range(3)], (
+            'При остановке сообщения из очереди должны быть досланы.'
+        )
+        assert bot.closed
+
+
+class TestDigest:
+    WINDOW = 0.05
+
+    def start_digest(self, homework_module, sender):
+        digest = homework_module.Digest(sender, window=self.WINDOW)
+        thread = threading.Thread(target=digest.run, daemon=True)
+        thread.start()
+        return digest, thread
+
+    def test_window_survives_connection_error(self, homework_module):
+        bot = FlakyBot(failures=0)
+        digest, thread = self.start_digest(homework_module, bot)
+        digest.send_message(1, 'first')
+        bot.failures = 1
+        digest.send_message(1, 'lost 0')
+        digest.send_message(1, 'lost 1')
+        time.sleep(self.WINDOW * 4)
+        digest.send_message(1, 'later')
+        assert thread.is_alive(), (
+            'Поток сводок не должен завершаться при ошибке отправки.'
+        )
+        assert bot.sent == [(1, 'first'), (1, 'later')], (
+            'После неудачной сводки окно чата должно закрываться, '
+            'а следующее сообщение -- отправляться сразу.'
+        )
+        assert not digest.pending[1]
+
+    def test_digest_reports_every_key(self, homework_module):
+        bot = FlakyBot(failures=0)
+        sender = homework_module.MessageQueue(
+            bot, workers=1, limiter=get_fast_limiter(homework_module)
+        )
+        digest, _ = self.start_digest(homework_module, sender)
+        done = []
+        digest.on_done = done.append
+        for number in range(3):
+            digest.put(1, f'text {number}', f'k{number}')
+        time.sleep(self.WINDOW * 3)
+        sender.join()
+        assert [text for _, text in bot.sent][0] == 'text 0'
+        assert len(bot.sent) == 2
+        assert 'text 1' in bot.sent[1][1] and 'text 2' in bot.sent[1][1]
+        assert sorted(done) == ['k0', 'k1', 'k2'], (
+            'Доставка сводки должна подтверждать в outbox каждое '
+            'сообщение, вошедшее в неё.'
+        )
+
+    def test_close_delivers_through_queue(self, homework_module):
+        bot = FlakyBot(failures=0)
+        sender = homework_module.MessageQueue(
+            bot, workers=1, limiter=get_fast_limiter(homework_module)
+        )
+        digest = homework_module.Digest(sender, window=60)
+        for number in range(3):
+            digest.send_message(1, f'text {number}')
+        digest.close()
+        assert len(bot.sent) == 2, (
+            'При остановке накопленные сводки должны быть доставлены.'
+        )
+
+
+class RecordingSender:
+    """Очередь отправки, которая только запоминает сообщения."""
+
+    def __init__(self):
+        self.on_done = None
+        self.on_failed = None
+        self.messages = []
+
+    def put(self, chat_id, text, key=None):
+        self.messages.append((chat_id, text, key))
+
+
+class TestOutbox:
+
+    def test_message_reaches_file_before_fsync(
+        self, homework_module, tmp_path
+    ):
+        path = str(tmp_path / 'outbox')
+        outbox = homework_module.Outbox(
+            RecordingSender(), path, flush_interval=3600
+        )
+        outbox.load()
+        outbox.send_message(1, 'text')
+        with open(path, encoding='utf-8') as file:
+            assert '"text"' in file.read(), (
+                'Сообщение outbox должно попадать в файл сразу, до того '
+                'как журнал состояния отметит домашку отправленной.'
+            )
+
+    def test_same_text_of_different_changes_is_kept(
+        self, homework_module, tmp_path
+    ):
+        outbox = homework_module.Outbox(
+            RecordingSender(), str(tmp_path / 'outbox')
+        )
+        outbox.load()
+        outbox.send_message(1, 'rejected', key='change-1')
+        outbox.send_message(1, 'rejected', key='change-2')
+        outbox.send_message(1, 'rejected', key='change-2')
+        assert len(outbox) == 2, (
+            'Два изменения статуса с одинаковым текстом -- два сообщения, '
+            'повтор одного изменения -- одно.'
+        )
+
+    def test_status_key_depends_on_state(self, homework_module, tmp_path):
+        outbox = homework_module.Outbox(
+            RecordingSender(), str(tmp_path / 'outbox')
+        )
+        tenant = homework_module.Tenant('student')
+        first, second = (
+            homework_module.Homework(1, 'hw', 2, updated)
+            for updated in (100, 200)
+        )
+        keys = {
+            homework_module.get_status_key(outbox, tenant, homework)
+            for homework in (first, second, first)
+        }
+        assert len(keys) == 2
+
+
+class TestTokenBucket:
+
+    def test_burst_then_wait(self, homework_module):
+        bucket = homework_module.TokenBucket(rate=10, capacity=2)
+        assert bucket.reserve() == 0
+        assert bucket.reserve() == 0
+        assert bucket.reserve() == pytest.approx(0.1, abs=0.01), (
+            'После запаса capacity каждое событие ждёт 1 / rate секунд.'
+        )
+        assert bucket.reserve() == pytest.approx(0.2, abs=0.01)
+
+    def test_refill_is_capped(self, homework_module):
+        bucket = homework_module.TokenBucket(rate=10, capacity=2)
+        bucket.updated -= 100
+        assert [bucket.reserve() for _ in range(2)] == [0, 0]
+        assert bucket.reserve() > 0, (
+            'Простой не должен копить токенов больше capacity.'
+        )
+
+    def test_chat_limit_is_per_chat(self, homework_module):
+        limiter = homework_module.RateLimiter(global_rate=100, chat_rate=1)
+        assert limiter.reserve(1) == 0
+        assert limiter.reserve(2) == 0, (
+            'Лимит одного чата не должен задерживать другие чаты.'
+        )
+        assert limiter.reserve(1) == pytest.approx(1, abs=0.01)
+
+    def test_global_limit_is_shared(self, homework_module):
+        limiter = homework_module.RateLimiter(global_rate=2, chat_rate=100)
+        assert [limiter.reserve(chat_id) for chat_id in (1, 2)] == [0, 0]
+        assert limiter.reserve(3) == pytest.approx(0.5, abs=0.01)
+
+
+class TestOutboxReplay:
+
+    def open_outbox(self, homework_module, path):
+        sender = RecordingSender()
+        outbox = homework_module.Outbox(sender, str(path), retry_interval=0)
+        outbox.load()
+        return outbox, sender
+
+    def test_unacked_messages_are_replayed(self, homework_module, tmp_path):
+        path = tmp_path / 'outbox'
+        outbox, _ = self.open_outbox(homework_module, path)
+        outbox.send_message(1, 'delivered', key='k1')
+        outbox.send_message(2, 'lost', key='k2')
+        outbox.ack('k1')
+        outbox.close()
+
+        outbox, sender = self.open_outbox(homework_module, path)
+        assert sender.messages == [(2, 'lost', 'k2')], (
+            'После перезапуска повторяются только неподтверждённые '
+            'сообщения.'
+        )
+        assert len(outbox) == 1
+        outbox.close()
+        lines = path.read_text(encoding='utf-8').splitlines()
+        assert lines == ['["a","k2",2,"lost"]'], (
+            'При загрузке журнал outbox сжимается до недоставленных.'
+        )
+
+    def test_failed_message_is_retried(self, homework_module, tmp_path):
+        outbox, sender = self.open_outbox(homework_module, tmp_path / 'o')
+        outbox.send_message(1, 'text', key='k1')
+        outbox.fail('k1')
+        outbox.maintain()
+        assert sender.messages == [(1, 'text', 'k1')] * 2
+        outbox.ack('k1')
+        outbox.fail('k1')
+        outbox.maintain()
+        assert len(sender.messages) == 2, (
+            'Доставленное сообщение не отправляется повторно.'
+        )
+        outbox.close()
+
+
+class TestDigestWindow:
+
+    def test_window_collects_messages(self, homework_module):
+        bot = FlakyBot(failures=0)
+        digest = homework_module.Digest(bot, window=60)
+        digest.send_message(1, 'first')
+        digest.send_message(1, 'second')
+        digest.send_message(1, 'third')
+        digest.send_message(2, 'other chat')
+        assert bot.sent == [(1, 'first'), (2, 'other chat')], (
+            'Первое сообщение чата отправляется сразу, следующие в окне '
+            'копятся; окна чатов независимы.'
+        )
+        digest.flush(1)
+        assert len(bot.sent) == 3
+        assert bot.sent[2][1].startswith('Сводка обновлений: 2')
+        assert 'second' in bot.sent[2][1] and 'third' in bot.sent[2][1]
+
+    def test_empty_window_makes_chat_idle(self, homework_module):
+        bot = FlakyBot(failures=0)
+        digest = homework_module.Digest(bot, window=60)
+        digest.send_message(1, 'first')
+        digest.send_message(1, 'second')
+        digest.flush(1)
+        digest.send_message(1, 'third')
+        assert len(bot.sent) == 2, (
+            'После сводки открывается новое окно.'
+        )
+        digest.flush(1)
+        digest.flush(1)
+        digest.send_message(1, 'fourth')
+        assert bot.sent[-1] == (1, 'fourth'), (
+            'Когда окно закрылось пустым, следующее сообщение уходит сразу.'
+        )
+
+    def test_long_digest_is_split(self, homework_module):
+        limit = homework_module.TELEGRAM_MESSAGE_LIMIT
+        items = [('x' * (limit // 3), f'k{number}') for number in range(6)]
+        digests = homework_module.format_digest(items)
+        assert len(digests) > 1
+        assert all(len(text) <= limit for text, _ in digests)
+        assert sorted(
+            key for _, keys in digests for key in keys
+        ) == [f'k{number}' for number in range(6)]
@@ -0,0 +1,224 @@
+import asyncio
+import json
+import threading
+
+import pytest
+
+
+class TestHashRing:
+    NAMES = [f'student{number}' for number in range(300)]
+
+    def test_assignment_is_stable(self, homework_module):
+        first = homework_module.HashRing([0, 1, 2])
+        second = homework_module.HashRing([2, 0, 1])
+        assert all(
+            first.get_node(name) == second.get_node(name)
+            for name in self.NAMES
+        ), 'Сегмент пользователя не должен зависеть от порядка процессов.'
+
+    def test_every_node_gets_tenants(self, homework_module):
+        ring = homework_module.HashRing([0, 1, 2])
+        nodes = [ring.get_node(name) for name in self.NAMES]
+        assert {node: nodes.count(node) > 50 for node in range(3)} == {
+            0: True, 1: True, 2: True
+        }
+
+    def test_only_tenants_of_removed_node_move(self, homework_module):
+        before = homework_module.HashRing([0, 1, 2])
+        after = homework_module.HashRing([0, 2])
+        moved = [
+            name for name in self.NAMES
+            if before.get_node(name) != after.get_node(name)
+        ]
+        assert moved
+        assert all(before.get_node(name) == 1 for name in moved), (
+            'При выходе процесса переходят только его пользователи.'
+        )
+        assert {after.get_node(name) for name in moved} == {0, 2}
+
+
+class TestMergeMetrics:
+    PAGE = (
+        '# HELP homework_polls_total Опросы API\n'
+        '# TYPE homework_polls_total counter\n'
+        'homework_polls_total 3\n'
+        '# HELP homework_errors_total Ошибки\n'
+        '# TYPE homework_errors_total counter\n'
+        'homework_errors_total{kind="api"} 1\n'
+    )
+
+    def test_samples_get_worker_label(self, homework_module):
+        page = homework_module.merge_metrics([(0, self.PAGE)])
+        assert 'homework_polls_total{worker="0"} 3' in page
+        assert 'homework_errors_total{kind="api",worker="0"} 1' in page
+
+    def test_family_header_is_written_once(self, homework_module):
+        page = homework_module.merge_metrics(
+            [(0, self.PAGE), (1, self.PAGE)]
+        )
+        lines = page.splitlines()
+        assert lines.count('# TYPE homework_polls_total counter') == 1
+        start = lines.index('# TYPE homework_polls_total counter')
+        assert lines[start + 1:start + 3] == [
+            'homework_polls_total{worker="0"} 3',
+            'homework_polls_total{worker="1"} 3',
+        ], 'Сэмплы всех процессов должны идти за заголовком своей метрики.'
+
+
+class TestTakeOver:
+
+    def open_worker(self, homework_module, monkeypatch, tmp_path, worker):
+        path = str(tmp_path / f'state.{worker}')
+        monkeypatch.setattr(homework_module, 'STATE_FILE', path)
+        monkeypatch.setattr(homework_module, 'WORKER_ID', str(worker))
+        return homework_module.open_state_store()
+
+    def write_journal(self, path, entries):
+        with open(path, 'w', encoding='utf-8') as file:
+            for entry in entries:
+                file.write(json.dumps(entry) + '\n')
+
+    def test_gained_tenant_continues_from_previous_owner(
+        self, homework_module, monkeypatch, tmp_path
+    ):
+        reviewing = homework_module.pack_state(homework_module.REVIEWING, 50)
+        approved = homework_module.pack_state(0, 100)
+        self.write_journal(tmp_path / 'state.1', [
+            ('c', 'student', 1000),
+            ('h', 'student', 1, approved),
+            ('h', 'student', 2, reviewing),
+            ('h', 'other', 3, approved),
+        ])
+        store = self.open_worker(homework_module, monkeypatch, tmp_path, 0)
+        tenant = homework_module.Tenant('student')
+        tenant.timestamp = 10
+        tenant.owned = False
+        homework_module.assign_shard([tenant], [0], store)
+        assert tenant.owned
+        assert tenant.timestamp == 1000, (
+            'Новый владелец пользователя должен продолжать опрос с курсора '
+            'прежнего владельца, а не со своего времени запуска.'
+        )
+        assert store.get('student', 1) == approved
+        assert tenant.reviewing == {2}
+        assert store.get('other', 3) is None
+        store.journal.close()
+
+    def test_newest_state_wins(self, homework_module, monkeypatch, tmp_path):
+        old = homework_module.pack_state(homework_module.REVIEWING, 50)
+        new = homework_module.pack_state(0, 100)
+        self.write_journal(tmp_path / 'state.0', [
+            ('c', 'student', 500), ('h', 'student', 1, old),
+        ])
+        self.write_journal(tmp_path / 'state.1', [
+            ('c', 'student', 1000), ('h', 'student', 1, new),
+        ])
+        store = self.open_worker(homework_module, monkeypatch, tmp_path, 0)
+        tenant = homework_module.Tenant('student')
+        store.restore([tenant])
+        tenant.owned = False
+        homework_module.assign_shard([tenant], [0], store)
+        assert store.get('student', 1) == new, (
+            'Перезапущенный процесс не должен опираться на свой '
+            'устаревший журнал.'
+        )
+        assert tenant.timestamp == 1000
+        assert not tenant.reviewing
+        store.journal.close()
+        restored = self.open_worker(
+            homework_module, monkeypatch, tmp_path, 0
+        )
+        assert restored.get('student', 1) == new
+        assert restored.cursors['student'] == 1000
+        restored.journal.close()
+
+
+class TestHandoverSchedule:
+
+    def test_foreign_tenant_does_not_back_off(
+        self, homework_module, monkeypatch
+    ):
+        monkeypatch.setattr(homework_module, 'ADAPTIVE_POLLING', True)
+        tenant = homework_module.Tenant('student')
+        tenant.owned = False
+        for _ in range(10):
+            delay = tenant.schedule_next_poll()
+        assert delay == homework_module.HANDOVER_CHECK_PERIOD
+        assert tenant.interval == tenant.base_interval, (
+            'Период опроса чужого пользователя не должен расти, иначе '
+            'после передачи его опросят с большой задержкой.'
+        )
+
+    @pytest.fixture
+    def foreign_tenant(self, homework_module, monkeypatch):
+        monkeypatch.setattr(homework_module, 'WORKER_ID', '0')
+        monkeypatch.setattr(homework_module, 'POLL_STAGGER', False)
+        tenant = homework_module.Tenant('student')
+        tenant.interval = homework_module.IDLE_MAX_PERIOD
+        tenant.owned = False
+        return tenant
+
+    def test_gained_tenant_is_polled_at_once(
+        self, homework_module, monkeypatch, foreign_tenant
+    ):
+        polled = []
+        monkeypatch.setattr(
+            homework_module, 'poll_tenant',
+            lambda bot, tenant, store, breaker: polled.append(tenant.active)
+        )
+        scheduler = homework_module.DeadlineScheduler([foreign_tenant])
+        scheduler.poll_due(None, None, None)
+        assert polled == [False]
+        homework_module.assign_shard(
+            [foreign_tenant], [0], homework_module.StateStore()
+        )
+        scheduler.poll_due(None, None, None)
+        assert polled == [False, True], (
+            'Перешедшего пользователя планировщик опрашивает сразу, '
+            'а не по старому сроку в куче.'
+        )
+        assert foreign_tenant.interval == foreign_tenant.base_interval
+
+    def test_gained_tenant_wakes_async_watch(
+        self, homework_module, monkeypatch, foreign_tenant
+    ):
+        polled = []
+
+        async def poll(session, bot, tenant, store, breaker):
+            polled.append(tenant.active)
+
+        monkeypatch.setattr(homework_module, 'async_poll_tenant', poll)
+        scheduler = homework_module.DeadlineScheduler([foreign_tenant])
+
+        async def run():
+            watch = asyncio.create_task(homework_module.async_watch(
+                None, None, foreign_tenant, None, None, scheduler
+            ))
+            await asyncio.sleep(0.05)
+            # Handed over by the supervisor thread.
+            thread = threading.Thread(
+                target=homework_module.assign_shard,
+                args=([foreign_tenant], [0], homework_module.StateStore())
+            )
+            thread.start()
+            thread.join()
+            await asyncio.sleep(0.05)
+            watch.cancel()
+
+        asyncio.run(run())
+        assert polled == [False, True], (
+            'Перешедшего пользователя нужно опросить сразу, не дожидаясь '
+            'конца текущего ожидания.'
+        )
+
+    def test_gained_lease_resets_schedule(self, homework_module):
+
+        class Backend:
+            def acquire(self, node, cursors, ttl):
+                return {name: 100 for name in cursors}
+
+        tenant = homework_module.Tenant('student')
+        keeper = homework_module.LeaseKeeper(Backend(), [tenant])
+        tenant.next_poll = float('inf')
+        keeper.renew()
+        assert tenant.leased and tenant.is_due()
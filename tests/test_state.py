@@ -0,0 +1,83 @@
+import json
+
+
+class TestStateStore:
+
+    def test_least_recently_used_is_evicted(self, homework_module):
+        store = homework_module.StateStore(max_size=2)
+        store.set('student', 1, 10)
+        store.set('student', 2, 20)
+        assert store.get('student', 1) == 10
+        store.set('student', 3, 30)
+        assert store.get('student', 2) is None, (
+            'Из заполненного хранилища вытесняется давно использованная '
+            'домашка, а не прочитанная последней.'
+        )
+        assert store.get('student', 1) == 10
+        assert store.get('student', 3) == 30
+        assert len(store) == 2
+
+    def test_update_overwrites_without_growth(self, homework_module):
+        store = homework_module.StateStore(max_size=2)
+        for state in range(5):
+            store.set('student', 1, state)
+        assert len(store) == 1
+        assert store.get('student', 1) == 4
+
+
+class TestStateJournal:
+
+    def open_store(self, homework_module, path):
+        journal = homework_module.StateJournal(str(path))
+        store = homework_module.StateStore(journal=journal)
+        journal.load(store)
+        journal.compact(store)
+        return store
+
+    def test_replay_restores_states_and_cursors(
+        self, homework_module, tmp_path
+    ):
+        path = tmp_path / 'state'
+        store = self.open_store(homework_module, path)
+        tenant = homework_module.Tenant('student')
+        for updated in (100, 200):
+            store.update('student', homework_module.Homework(
+                1, 'hw', homework_module.REVIEWING, updated
+            ))
+        tenant.timestamp = 1234
+        store.save_cursor(tenant)
+        store.journal.close()
+
+        restored = self.open_store(homework_module, path)
+        assert restored.get('student', 1) == homework_module.pack_state(
+            homework_module.REVIEWING, 200
+        ), 'При повторе журнала побеждает последняя запись.'
+        tenant = homework_module.Tenant('student')
+        restored.restore([tenant])
+        assert tenant.timestamp == 1234
+        assert tenant.reviewing == {1}
+        restored.journal.close()
+
+    def test_cut_record_is_skipped(self, homework_module, tmp_path):
+        path = tmp_path / 'state'
+        path.write_text(
+            json.dumps(['h', 'student', 1, 5]) + '\n["h","student",2,',
+            encoding='utf-8'
+        )
+        store = self.open_store(homework_module, path)
+        assert store.get('student', 1) == 5
+        assert len(store) == 1
+        store.journal.close()
+
+    def test_compact_keeps_only_snapshot(self, homework_module, tmp_path):
+        path = tmp_path / 'state'
+        store = self.open_store(homework_module, path)
+        for state in range(10):
+            store.set('student', 1, state)
+            store.journal.write(('h', 'student', 1, state))
+        store.journal.close()
+        self.open_store(homework_module, path).journal.close()
+        lines = path.read_text(encoding='utf-8').splitlines()
+        assert lines == ['["h","student",1,9]'], (
+            'При запуске журнал сжимается до текущего снимка.'
+        )
@@ -0,0 +1,67 @@
+import json
+
+import pytest
+
+HOMEWORKS = [
+    {'id': 1, 'homework_name': 'Домашка «Бот»', 'status': 'approved'},
+    {'id': 2, 'homework_name': 'hw_2', 'status': 'reviewing',
+     'reviewer_comment': 'Проверка [началась], {скоро} ответ'},
+    {'id': 3, 'homework_name': 'ёжик', 'status': 'rejected'},
+]
+
+
+def get_body(current_date_first=False):
+    if current_date_first:
+        return json.dumps(
+            {'current_date': 1700, 'homeworks': HOMEWORKS}, ensure_ascii=False
+        ).encode()
+    return json.dumps(
+        {'homeworks': HOMEWORKS, 'current_date': 1700}, ensure_ascii=False
+    ).encode()
+
+
+def split(body, size):
+    return [body[start:start + size] for start in range(0, len(body), size)]
+
+
+class TestHomeworkStream:
+
+    @pytest.mark.parametrize('size', [1, 2, 3, 7, 64, 10 ** 6])
+    def test_any_chunk_size(self, homework_module, size):
+        stream = homework_module.HomeworkStream(split(get_body(), size))
+        assert list(stream) == HOMEWORKS, (
+            'Разбор не должен зависеть от того, где тело разрезано '
+            'на куски, в том числе внутри многобайтового символа UTF-8.'
+        )
+        assert stream.current_date == 1700
+
+    @pytest.mark.parametrize('size', [1, 5, 10 ** 6])
+    def test_current_date_before_homeworks(self, homework_module, size):
+        stream = homework_module.HomeworkStream(
+            split(get_body(current_date_first=True), size)
+        )
+        assert list(stream) == HOMEWORKS
+        assert stream.current_date == 1700
+
+    def test_without_current_date(self, homework_module):
+        stream = homework_module.HomeworkStream([b'{"homeworks": []}'])
+        assert list(stream) == []
+        assert stream.current_date is None
+
+    def test_chunks_are_read_lazily(self, homework_module):
+        chunks = iter(split(get_body(), 16))
+        stream = iter(homework_module.HomeworkStream(chunks))
+        assert next(stream) == HOMEWORKS[0]
+        assert next(chunks, None) is not None, (
+            'Домашки должны отдаваться до того, как прочитано всё тело.'
+        )
+
+    @pytest.mark.parametrize('cut', [10, 40, -30, -24])
+    def test_truncated_body(self, homework_module, cut):
+        body = get_body()[:cut]
+        with pytest.raises((ValueError, KeyError)):
+            list(homework_module.HomeworkStream(split(body, 8)))
+
+    def test_no_homeworks_key(self, homework_module):
+        with pytest.raises(KeyError):
+            list(homework_module.HomeworkStream([b'{"current_date": 1}']))
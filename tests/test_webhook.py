@@ -0,0 +1,75 @@
+import http.client
+import threading
+
+import pytest
+
+
+class TestWebhookServer:
+
+    @pytest.fixture
+    def server(self, homework_module, monkeypatch):
+        monkeypatch.setattr(homework_module, 'WEBHOOK_PORT', 0)
+        monkeypatch.setattr(homework_module, 'WEBHOOK_MAX_BODY', 100)
+        server = homework_module.WebhookServer(
+            None,
+            [homework_module.Tenant(name) for name in ('student', 'ann lee')],
+            homework_module.StateStore()
+        )
+        threading.Thread(
+            target=server.serve_forever, args=(0.05,), daemon=True
+        ).start()
+        yield server
+        server.shutdown()
+        server.server_close()
+
+    def post(self, server, length):
+        connection = http.client.HTTPConnection(*server.server_address)
+        connection.putrequest('POST', '/homeworks/student')
+        connection.putheader('Content-Length', length)
+        connection.endheaders()
+        status = connection.getresponse().status
+        connection.close()
+        return status
+
+    def post_event(self, server, path):
+        connection = http.client.HTTPConnection(*server.server_address)
+        connection.request('POST', path, body=b'{"homeworks": []}')
+        status = connection.getresponse().status
+        connection.close()
+        return status
+
+    def test_path_is_decoded(self, server):
+        assert self.post_event(server, '/homeworks/ann%20lee') == 200, (
+            'Имя пользователя в пути нужно декодировать, как это делает '
+            'приёмник aiohttp.'
+        )
+        assert self.post_event(server, '/homeworks/student?retry=1') == 200
+        assert self.post_event(server, '/homeworks/nobody') == 404
+
+    def test_bad_content_length(self, server):
+        assert self.post(server, 'ten') == 400, (
+            'Нечисловой Content-Length должен отклоняться с кодом 400.'
+        )
+        assert self.post(server, '-1') == 400
+
+    def test_too_large_body(self, server):
+        assert self.post(server, '101') == 413, (
+            'Тело больше WEBHOOK_MAX_BODY должно отклоняться с кодом 413 '
+            'без чтения.'
+        )
+
+
+class TestWebhookSettings:
+
+    def test_external_host_requires_secret(
+        self, homework_module, monkeypatch
+    ):
+        monkeypatch.setattr(homework_module, 'WEBHOOK_HOST', '0.0.0.0')
+        monkeypatch.setattr(homework_module, 'WEBHOOK_SECRET', None)
+        with pytest.raises(ValueError):
+            homework_module.check_webhook_settings()
+        monkeypatch.setattr(homework_module, 'WEBHOOK_SECRET', 'secret')
+        homework_module.check_webhook_settings()
+
+    def test_local_by_default(self, homework_module):
+        assert homework_module.WEBHOOK_HOST == '127.0.0.1'